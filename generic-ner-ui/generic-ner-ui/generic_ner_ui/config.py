@@ -228,6 +228,33 @@ class ImageConfig(RequiredConfigMixin):
         return self.config(*args, **kwargs)
 
 
+class PdfConfig(RequiredConfigMixin):
+    """Contains the settings of the reviewed pdf export"""
+    required_config = ConfigOptions()
+
+    required_config.add_option(
+        'image_format',
+        parser=str,
+        doc="encoding of the page backgrounds: 'jpeg' or 'original'",
+        default='jpeg'
+    )
+
+    required_config.add_option(
+        'image_quality',
+        parser=int,
+        doc='jpeg quality (1-100) of the page backgrounds',
+        default='85'
+    )
+
+    def __init__(self, config):
+        self.config = config.with_options(self)
+        self.image_format = self.config('image_format')
+        self.image_quality = self.config('image_quality')
+
+    def __call__(self, *args, **kwargs):
+        return self.config(*args, **kwargs)
+
+
 class PipelineConfig(RequiredConfigMixin):
     required_config = ConfigOptions()
 
@@ -366,3 +393,4 @@ class Config(object):
         self.entitygroups = EntityGroupsConfig(self.manager
                                                .with_namespace('entitygroups'))
         self.image = ImageConfig(self.manager.with_namespace('image'))
+        self.pdf = PdfConfig(self.manager.with_namespace('pdf'))
@@ -35,7 +35,6 @@ from django.http import HttpResponse
 from main.views import create_single_pdf, download_pdf
 from generic_ner_ui.settings import SECRET, ALLOWED_IPS
 from loguru import logger
-from main.processing import compress
 from main.processing import download_minio_file
 
 def get_client_ip(request):
@@ -140,16 +139,10 @@ def download_pdf(request, id):
     with tempfile.NamedTemporaryFile(suffix='.pdf', delete=True) as temp_1:
         _ = create_single_pdf(run.result_data.data['pages'], temp_1.name)
 
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=True) as temp_2:
-            success = compress(temp_1.name, temp_2.name, power=1)
-            export_file = temp_1.name
-            if success:
-                export_file = temp_2.name
-
-            with open(export_file, 'rb') as file:
-                response = HttpResponse(file.read(), content_type='application/pdf')
-                response['Content-Disposition'] = f'attachment; filename="{pdf_path}"'
-                return response
+        with open(temp_1.name, 'rb') as file:
+            response = HttpResponse(file.read(), content_type='application/pdf')
+            response['Content-Disposition'] = f'attachment; filename="{pdf_path}"'
+            return response
 
     #response = HttpResponse(content_type='application/pdf')
     #response['Content-Disposition'] = f'attachment; filename="{pdf_path}"'
@@ -3,10 +3,8 @@ import datetime
 import io
 import itertools
 import pytz
-import subprocess
 import os.path
 import sys
-import shutil
 from pathlib import Path
 import math
 
@@ -16,6 +14,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.http import HttpResponse
 from loguru import logger
 from minio import Minio
+from PIL import Image
 
 from generic_ner_ui.models import Run, RunResult, Status
 from generic_ner_ui.static import config
@@ -288,45 +287,23 @@ def get_folder_size(minio_bucket, object_id):
     return total
 
 
-def compress(input_file_path, output_file_path, power=0):
-    """Function to compress PDF via Ghostscript command line interface"""
-    quality = {
-        0: '/default',
-        1: '/prepress',
-        2: '/printer',
-        3: '/ebook',
-        4: '/screen'
-    }
-    try:
-        if not os.path.isfile(input_file_path):
-            logger.info(f"Error: invalid path for input PDF file")
-            return False
-
-        if input_file_path.split('.')[-1].lower() != 'pdf':
-            logger.info(f"Error: input file is not a PDF")
-            return False
-
-        gs = get_ghostscript_path()
-        initial_size = os.path.getsize(input_file_path)
-        subprocess.call([gs, '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
-                        '-dPDFSETTINGS={}'.format(quality[power]),
-                        '-dNOPAUSE', '-dQUIET', '-dBATCH',
-                        '-sOutputFile={}'.format(output_file_path),
-                         input_file_path])
-        # final_size = os.path.getsize(output_file_path)
-        # ratio = 1 - (final_size / initial_size)
-        # print("Compression by {0:.0%}.".format(ratio))
-        # print("Final file size is {0:.1f}MB".format(final_size / 1000000))
-        return True
-
-    except Exception as e:
-        logger.info(f"Error: {e}")
-        return False
-
-
-def get_ghostscript_path():
-    gs_names = ['gs', 'gswin32', 'gswin64']
-    for name in gs_names:
-        if shutil.which(name):
-            return shutil.which(name)
-    raise FileNotFoundError(f'No GhostScript executable was found on path ({"/".join(gs_names)})')
+def encode_pdf_background(image_stream, image_format='jpeg', quality=85):
+    """Encode a page background for the pdf export (replaces the ghostscript pass)
+
+    jpeg - baseline jpeg of the given quality, reportlab embeds it as it is
+    original - the downloaded image unchanged
+    returns (stream, size before, size after)
+    """
+    initial_size = image_stream.getbuffer().nbytes
+    if image_format == 'original':
+        return image_stream, initial_size, initial_size
+    if image_format != 'jpeg':
+        raise Exception(f"Invalid pdf image format '{image_format}', must be 'jpeg' or 'original'")
+
+    with Image.open(image_stream) as img:
+        if img.mode not in ('L', 'RGB'):
+            img = img.convert('L' if img.mode in ('1', 'I', 'I;16') else 'RGB')
+        out = io.BytesIO()
+        img.save(out, format='JPEG', quality=quality, optimize=True)
+    out.seek(0)
+    return out, initial_size, out.getbuffer().nbytes
@@ -5,6 +5,7 @@ import json
 import os
 import zipfile
 import tempfile
+import time
 from io import BytesIO
 from pathlib import Path
 from urllib import response
@@ -37,7 +38,7 @@ from generic_ner_ui.static import config
 from generic_ner_ui.utils import redirect
 from main.processing import download_minio_file, start_processing, \
     get_files_to_download_any, download_file_to_stream, update_pdf, \
-    download_minio_file_data, compress, get_folder_size, convert_size, has_tiff_file
+    download_minio_file_data, encode_pdf_background, get_folder_size, convert_size, has_tiff_file
 
 pdfmetrics.registerFont(TTFont('FreeSans', 'static/FreeSans.ttf', 'UTF-8'))
 
@@ -627,16 +628,10 @@ def download_pdf(request, id):
     with tempfile.NamedTemporaryFile(suffix='.pdf', delete=True) as temp_1:
         _ = create_single_pdf(run.result_data.data['pages'], temp_1.name)
 
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=True) as temp_2:
-            success = compress(temp_1.name, temp_2.name, power=1)
-            export_file = temp_1.name
-            if success:
-                export_file = temp_2.name
-
-            with open(export_file, 'rb') as file:
-                response = HttpResponse(file.read(), content_type='application/pdf')
-                response['Content-Disposition'] = f'attachment; filename="{pdf_path}"'
-                return response
+        with open(temp_1.name, 'rb') as file:
+            response = HttpResponse(file.read(), content_type='application/pdf')
+            response['Content-Disposition'] = f'attachment; filename="{pdf_path}"'
+            return response
 
     # # prepare DB update
     # minio_bucket, object_id = run.result_prep["output"].split('/', 1)
@@ -651,7 +646,11 @@ def download_pdf(request, id):
 def create_single_pdf(data, outfile):
     font_name = 'FreeSans'
     padding = 20
-    pdf = canvas.Canvas(outfile)
+    start = time.time()
+    initial_size, final_size = 0, 0
+    # backgrounds are encoded before drawing and page streams are deflated,
+    # so the pdf needs no ghostscript pass afterwards
+    pdf = canvas.Canvas(outfile, pageCompression=1)
     pdf.setTitle("BOW - Batch OCR Webservice")
     pdf.setAuthor("BOW - Batch OCR Webservice")
     pdf.setSubject("Created by BOW - Batch OCR Webservice")
@@ -661,7 +660,11 @@ def create_single_pdf(data, outfile):
 
         # insert document background
         minio_path_img = data[i]["preprocessing"]["minio"]
-        image_stream = download_minio_file_data(minio_path_img)
+        image_stream, image_size, encoded_size = encode_pdf_background(
+            download_minio_file_data(minio_path_img),
+            config.pdf.image_format, config.pdf.image_quality)
+        initial_size += image_size
+        final_size += encoded_size
         temporary_image = ImageReader(image_stream)
         pdf.setPageSize((row['preprocessing']['width'], row['preprocessing']['height']))
         pdf.drawImage(temporary_image, 0, 0, width=row['preprocessing']['width'], height=row['preprocessing']['height'])
@@ -706,6 +709,9 @@ def create_single_pdf(data, outfile):
             pdf.drawText(text)
         pdf.showPage()
     pdf.save()
+    logger.info("pdf backgrounds {0:.1f}MB -> {1:.1f}MB, pdf {2:.1f}MB written in {3:.1f}s".format(
+        initial_size / 1000000, final_size / 1000000,
+        os.path.getsize(outfile) / 1000000, time.time() - start))
     return pdf
 
 
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+compare the bulk page payload (page_entries_payload) with the former
+iterrows based Pipeline.convert_page on synthetic pages, the json of both
+payloads has to be identical (float and int confidences, missing
+corrections)
+
+usage: python benchmarks/convert_page_benchmark.py [words ...]
+'''
+
+import json
+import random
+import string
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from ocr_pipeline.pipeline.word_boxes import WordBoxes, page_entries_payload
+
+
+def legacy_page_entries_payload(entries, correction_included):
+    '''
+    former convert_page body on the dict-of-dicts entries
+    '''
+    entries = pd.DataFrame.from_dict(entries)
+    converted_entries = [
+        {
+            "top": entry.top,
+            "conf": entry.conf,
+            "left": entry.left,
+            "text": entry.text,
+            "width": entry.width,
+            "height": entry.height,
+            "time": None,  # entry.time,
+            "correction": entry.corrections if correction_included and entry.corrections != '[UNK]' else ""
+        }
+        for _, entry in entries.iterrows()
+    ]
+
+    entities = []
+    start = 0
+    for entry in converted_entries:
+        end = start + len(entry["text"])
+        if entry["time"]:
+            entities.append({
+                "start": start,
+                "end": end,
+                "score": 1.0,
+                "type": "time",
+                "value": entry["time"],
+            })
+
+        start = end + 1
+
+    text = " ".join(entry["text"] for entry in converted_entries)
+    return converted_entries, text, entities
+
+
+def synthetic_page(words, seed=0, int_conf=False, missing_corrections=False):
+    '''
+    int_conf - integer confidences as in the tesseract 4 tsv
+    missing_corrections - NaN corrections for some words
+    '''
+    rng = random.Random(seed)
+    corrections = [None, '', '[UNK]', "['word']"] if missing_corrections \
+        else ['', '[UNK]', "['word']"]
+    df = pd.DataFrame({
+        'level': [5] * words,
+        'left': [rng.randint(0, 2000) for _ in range(words)],
+        'top': [rng.randint(0, 3000) for _ in range(words)],
+        'width': [rng.randint(5, 300) for _ in range(words)],
+        'height': [rng.randint(10, 60) for _ in range(words)],
+        'conf': [rng.randint(0, 100) if int_conf
+                 else round(rng.uniform(0, 100), 6) for _ in range(words)],
+        'text': [''.join(rng.choices(string.ascii_letters, k=rng.randint(1, 12)))
+                 for _ in range(words)],
+        'corrections': [rng.choice(corrections) for _ in range(words)],
+    })
+    df['corrections'] = df['corrections'].replace({None: np.nan})
+    return df
+
+
+PAGES = {
+    'float conf': {},
+    'int conf': {'int_conf': True},
+    'missing corrections': {'missing_corrections': True},
+}
+
+
+def main(sizes):
+    repeat = 5
+    for name, kwargs in PAGES.items():
+        df = synthetic_page(100, **kwargs)
+        boxes = WordBoxes.from_dataframe(df)
+        for correction_included in [True, False]:
+            assert json.dumps(legacy_page_entries_payload(
+                df.to_dict(), correction_included)) == json.dumps(
+                page_entries_payload(boxes, correction_included)), \
+                f"payload differs ({name})"
+
+    for words in sizes:
+        df = synthetic_page(words)
+        legacy_entries = df.to_dict()
+        boxes = WordBoxes.from_dataframe(df)
+
+        legacy = min(timeit.repeat(
+            lambda: legacy_page_entries_payload(legacy_entries, True),
+            number=1, repeat=repeat))
+        bulk = min(timeit.repeat(
+            lambda: page_entries_payload(boxes, True),
+            number=1, repeat=repeat))
+        print(f"{words:>6} words: iterrows {legacy * 1000:8.2f} ms, "
+              f"bulk {bulk * 1000:8.2f} ms, speedup {legacy / bulk:5.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [300, 1000, 3000])
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+compare the intermediate codecs (configure_intermediate_codec) on the
+work file round trips of the staged pipeline: grayscale write, the shape
+determination read (rotated in memory) and the binarization read, on
+synthetic scanned pages
+
+usage: python benchmarks/intermediate_codec_benchmark.py [pages]
+'''
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from ocr_pipeline.pipeline.file_preparation import INTERMEDIATE_CODECS, \
+    configure_intermediate_codec, open_pil_image, read_gray_image, \
+    save_pil_image
+
+
+def synthetic_page(width=2480, height=3508, seed=0):
+    '''
+    A4 at 300 dpi: paper noise with dark word-like blocks on text lines
+    '''
+    rng = np.random.default_rng(seed)
+    page = rng.normal(235, 8, (height, width, 3)).clip(0, 255)
+    for top in range(200, height - 200, 60):
+        left = 200
+        while left < width - 400:
+            word = int(rng.integers(40, 300))
+            page[top:top + 30, left:left + word] = rng.normal(
+                40, 20, (30, word, 1)).clip(0, 255)
+            left += word + int(rng.integers(20, 40))
+    return Image.fromarray(page.astype(np.uint8))
+
+
+def stages(page, path, dpi=300):
+    # 1 grayscale
+    save_pil_image(page.convert('L'), path, intermediate=True, dpi=dpi)
+    # 2 shape determination
+    open_pil_image(path).rotate(90, expand=True)
+    # 3 binarization reads the work file
+    return read_gray_image(path)
+
+
+def main(pages):
+    page = synthetic_page()
+    reference = None
+    with tempfile.TemporaryDirectory(prefix="codec_benchmark") as tmp_dir:
+        for codec in INTERMEDIATE_CODECS:
+            configure_intermediate_codec(codec)
+            paths = [os.path.join(tmp_dir, f"{codec}-{i}.png")
+                     for i in range(pages)]
+            start = time.time()
+            for path in paths:
+                gray = stages(page, path)
+            elapsed = time.time() - start
+
+            if reference is None:
+                reference = gray
+            assert np.array_equal(reference, gray), f"{codec} differs"
+
+            size = sum(os.path.getsize(path) for path in paths) / pages
+            print(f"{codec:>5}: {pages / elapsed:6.2f} pages/s, "
+                  f"{elapsed / pages * 1000:8.1f} ms/page, "
+                  f"{size / 1000000:6.2f} MB/file")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -5,7 +5,7 @@ echo "-- fetch_tess_traindata --"
 mkdir /home/work/tessdata_fast/
 mkdir /home/work/tessdata_best/
 
-tess_traindata=("deu.traineddata" "eng.traineddata" "fra.traineddata" "pol.traineddata" "rus.traineddata" "ukr.traineddata" "fin.traineddata")
+tess_traindata=("osd.traineddata" "deu.traineddata" "eng.traineddata" "fra.traineddata" "pol.traineddata" "rus.traineddata" "ukr.traineddata" "fin.traineddata")
 for i in "${tess_traindata[@]}"
 do
     wget -nv "https://github.com/tesseract-ocr/tessdata_fast/blob/main/"$i"?raw=true" -O /home/work/tessdata_fast/$i
@@ -2,6 +2,7 @@
 # coding: utf-8
 
 from functools import partial
+import io
 import json
 import os
 import time
@@ -14,13 +15,15 @@ import pandas as pd
 from PIL import Image
 from pytesseract import pytesseract
 from scipy import stats
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.rl_config import defaultPageSize
 from reportlab.pdfgen import canvas
 
 from ocr_pipeline.pipeline.graph_plot import plot_img
 from ocr_pipeline.pipeline.helpers import (
-    tesseract_extract_dataframe,
+    tesseract_extract_dataframe, tesseract_api_extract_dataframe,
+    parse_tess_config, cached_tess_api,
     image_to_data_stats, word_error_rate,
     create_dynamic_bin_size_range,
     transform_to_bitmap, run_cached
@@ -28,12 +31,16 @@ from ocr_pipeline.pipeline.helpers import (
 from ocr_pipeline.pipeline.spelling_correction import (
     get_spelling_correction,
     get_word_segmentation,
-    add_spelling_correction_to_dataframe
+    add_spelling_correction_to_dataframe,
+    correct_entries
 )
 from ocr_pipeline.pipeline.file_preparation import (
     open_pil_image,
+    read_gray_image,
     save_pil_image
 )
+from ocr_pipeline.pipeline.pdf_export import encode_background
+from ocr_pipeline.pipeline.word_boxes import WordBoxes, entries_dataframe
 
 
 def save_bytes_image(bytes_img, to_path):
@@ -43,8 +50,8 @@ def save_bytes_image(bytes_img, to_path):
 
 def img_to_grayscale(img_path, dpi=300):
     try:
-        img = Image.open(img_path).convert('L')
-        img.save(img_path, dpi=(dpi, dpi))
+        img = open_pil_image(img_path).convert('L')
+        save_pil_image(img, img_path, intermediate=True, dpi=dpi)
         return [img_path, True]
     except Exception as e:
         logger.warning(
@@ -53,7 +60,7 @@ def img_to_grayscale(img_path, dpi=300):
 
 
 def grayscale_to_binary(gray_img_path, thresh=127):
-    gray_img = cv2.imread(gray_img_path, 0)
+    gray_img = read_gray_image(gray_img_path)
     (thresh, binary_img) = cv2.threshold(gray_img, thresh, 255,
                                          cv2.THRESH_BINARY)
     return binary_img
@@ -63,7 +70,7 @@ def adaptive_binary(img_src, size, c, adaptiveMethod=0):
     if isinstance(img_src, Image.Image):
         gray_img = np.array(img_src)[:, :, None]
     else:
-        gray_img = cv2.imread(img_src, 0)
+        gray_img = read_gray_image(img_src)
 
     return adaptive_binary_gray(gray_img, size, c, adaptiveMethod)
 
@@ -261,14 +268,14 @@ def extract_text_from_image(file, size, c, method, sym_spell=False,
     elif isinstance(file, Image):
         img_binary = file
     else:
-        img_binary = cv2.imread(file, 0)
+        img_binary = read_gray_image(file)
         img_binary = Image.fromarray(img_binary)
 
     if rotate != 0:
         img_binary = img_binary.rotate(rotate, expand=True)
 
     if safe_temp is not None:
-        save_pil_image(img_binary, safe_temp)
+        save_pil_image(img_binary, safe_temp, intermediate=True)
 
     if plot:
         plot_img(img_binary)
@@ -298,7 +305,7 @@ def show_human_viewable(file_path):
     '''
     return corrected PIL img and rotation angle
     '''
-    im = Image.open(file_path)
+    im = open_pil_image(file_path)
     width, height = im.size
     if width > height:
         logger.debug("flipped 90° right")
@@ -433,45 +440,42 @@ def replace_pdf_background(pdf_path, img, out_path):
         logger.info(f"background {e}")
 
 
-def single_hocr_extract(file, bin_size, bin_c, bin_method,
-                        width_resized, height_resized, original=None,
-                        straight_angle=0, HOCR_DIR=None,
-                        tess_lang='eng', tess_config=''):
+def api_extract_dataframe(img, tess_lang='eng', tess_config=''):
     '''
-    file: path to img
-    temp save with unique filenames - multiproc may overwrite otherwise
+    extract word boxes with a cached in-process tesseract api
+    tess_config: tesseract cli config string, see parse_tess_config
     '''
-    if not HOCR_DIR:
-        HOCR_DIR = ""
-
-    FILE = os.path.splitext(original.lstrip(".").split("/")[-1])[0]
-    outfile_basename = f"{HOCR_DIR}{FILE}_tmp"
-    to_img_path_bin = f"{outfile_basename}_bin.png"
+    path, oem, psm, variables = parse_tess_config(tess_config)
+    with cached_tess_api(path=path, lang=tess_lang, oem=oem, psm=psm) as api:
+        for key, value in variables.items():
+            api.SetVariable(key, value)
+        return tesseract_api_extract_dataframe(img, api)
 
-    # resize
-    logger.info(f"resize parameters: width {width_resized}, height {height_resized}")
-    img = open_pil_image(original).convert('L').resize((width_resized, height_resized))
-
-    # rotate
-    if straight_angle != 0:
-        img = img.rotate(straight_angle, expand=True)
 
+def hocr_extract_image(img, bin_size, bin_c, bin_method, height_resized,
+                       tess_lang='eng', tess_config='', extractor='api'):
+    '''
+    img: grayscale PIL image, already rotated and resized
+    extractor: 'api' (in-process tesserocr) or 'pytesseract' (subprocess)
+    return filtered word boxes dataframe or None if no extraction is possible
+    '''
     # binarize
     if bin_size:
         logger.info(f"binarization parameters: {bin_size}, {bin_c}, {bin_method}")
         img_bin = adaptive_binary(img, bin_size, bin_c, bin_method)
         img = Image.fromarray(img_bin)
-    # save
-    save_pil_image(img, to_img_path_bin)
 
     # extract from bin
     try:
-        ocr_data = tesseract_extract_dataframe(img,
-                                               lang=tess_lang,
-                                               config=tess_config)
+        if extractor == 'api':
+            ocr_data = api_extract_dataframe(img, tess_lang, tess_config)
+        else:
+            ocr_data = tesseract_extract_dataframe(img,
+                                                   lang=tess_lang,
+                                                   config=tess_config)
     except Exception as e:
-        logger.info(f"no extraction possible: {e}, {to_img_path_bin}")
-        return file, None, straight_angle, None
+        logger.info(f"no extraction possible: {e}")
+        return None
 
     # filter dataframe
     try:
@@ -482,28 +486,56 @@ def single_hocr_extract(file, bin_size, bin_c, bin_method,
     if tess_lang == "Fraktur":
         ocr_data.text = ocr_data[ocr_data.text.notnull()].text.apply(lambda row: row.replace('ſ', 's'))
 
-    # remove temporary files
-    try:
-        os.remove(to_img_path_bin)
-    except Exception as e:
-        logger.info(f"error: remove temporary files, {e}")
+    return ocr_data
+
+
+def single_hocr_extract(file, bin_size, bin_c, bin_method,
+                        width_resized, height_resized, original=None,
+                        straight_angle=0, HOCR_DIR=None,
+                        tess_lang='eng', tess_config='', extractor='api',
+                        correction=None):
+    '''
+    file: path to img
+    correction: None or kwargs of correct_entries
+    '''
+    # resize
+    logger.info(f"resize parameters: width {width_resized}, height {height_resized}")
+    img = open_pil_image(original).convert('L').resize((width_resized, height_resized))
+
+    # rotate
+    if straight_angle != 0:
+        img = img.rotate(straight_angle, expand=True)
+
+    ocr_data = hocr_extract_image(img, bin_size, bin_c, bin_method,
+                                  height_resized, tess_lang, tess_config,
+                                  extractor)
+    if ocr_data is None:
+        return file, None, straight_angle, None
+
+    if correction:
+        ocr_data = correct_entries(ocr_data, **correction)
 
     # return hocr-data
-    return file, None, straight_angle, ocr_data.to_dict()
+    return file, None, straight_angle, WordBoxes.from_dataframe(ocr_data)
 
 
 def pipeline_hocr_extract(data, HOCR_DIR, HOCR_RESULTS_PATH, N_CPU,
-                          tess_lang='eng', tess_config=''):
+                          tess_lang='eng', tess_config='', extractor='api',
+                          correction=None):
     '''
     5. showcaser data extract
     df_gs - input dataframe from gridsearch
+    correction - None or kwargs of correct_entries, pages are spell
+    corrected in the same worker right after extraction
     '''
     logger.debug(list(data.columns))
     col_names = ['file', 'name', 'human_readable_rotation', 'entries']
     fn = partial(single_hocr_extract,
                  HOCR_DIR=HOCR_DIR,
                  tess_lang=tess_lang,
-                 tess_config=tess_config)
+                 tess_config=tess_config,
+                 extractor=extractor,
+                 correction=correction)
 
     files = list(data.file)
     add_params = [
@@ -531,22 +563,35 @@ def pipeline_hocr_extract(data, HOCR_DIR, HOCR_RESULTS_PATH, N_CPU,
 def pipeline_hocr_add_spellcorrection(data, 
                                       sym_spell, 
                                       repeated_words_list=[], 
-                                      dict_enchant="en_US"):
-    '''add spell correction to each ocr entry page'''
+                                      dict_enchant="en_US",
+                                      suggestion_cache=None,
+                                      profile='full',
+                                      conf_threshold=None):
+    '''
+    add spell correction to each ocr entry page
+    suggestion_cache - SuggestionCache shared by all pages
+    profile - correction profile 'full' or 'fast'
+    conf_threshold - words at or above it that are in the dictionary are kept
+    '''
     def convert_single(row):
         if row.entries is None:
-            return {}
+            return None
         try:
-            entries = pd.DataFrame.from_dict(row.entries)
+            entries = entries_dataframe(row.entries)
             entries = add_spelling_correction_to_dataframe(entries, sym_spell,
                                                            repeated_words_list,
-                                                           dict_enchant)
-            return entries.to_dict()
+                                                           dict_enchant,
+                                                           suggestion_cache,
+                                                           profile,
+                                                           conf_threshold)
+            return WordBoxes.from_dataframe(entries)
         except Exception as e:
             logger.info(e)
-            return {}
+            return None
 
     data["entries"] = data[["entries"]].apply(convert_single, axis=1)
+    if suggestion_cache is not None:
+        suggestion_cache.flush()
     return data
 
 
@@ -609,7 +654,7 @@ def pipeline_export_standard_formats(data, JSON_DIR, TXT_DIR,
             0] + '.json'
         out_file_path_txt = TXT_DIR + os.path.splitext(name.split('/')[-1])[
             0] + '.txt'
-        dataframe_to_structured_data(pd.DataFrame.from_dict(df),
+        dataframe_to_structured_data(entries_dataframe(df),
                                      out_file_path_json, out_file_path_txt,
                                      correction_included)
 
@@ -697,9 +742,9 @@ def merge_multiple_pdf_fitz(files_to_merge: list, out_file):
     sys.argv[1:] = saved_parms  # restore original parameters
 
 
-def create_single_pdf(data, out_path,title=None):
-    # create output file
-    pdf = canvas.Canvas(str(out_path))
+def create_single_pdf(data, out_path,title=None, image_format='jpeg', image_quality=85):
+    # create output file, page streams deflated
+    pdf = canvas.Canvas(str(out_path), pageCompression=1)
     if title == None:
         title = os.path.splitext(os.path.split(str(out_path))[1])[0]
     pdf.setTitle(title)
@@ -714,9 +759,11 @@ def create_single_pdf(data, out_path,title=None):
 
         # insert document background
         pdf.setPageSize((row.width_resized, row.height_resized))
-        pdf.drawImage(row.file_original, 0, 0, width=row.width_resized, height=row.height_resized)
+        # reportlab embeds jpeg data as it is
+        background = ImageReader(io.BytesIO(encode_background(row.file_original, image_format, image_quality)))
+        pdf.drawImage(background, 0, 0, width=row.width_resized, height=row.height_resized)
 
-        entries = pd.DataFrame.from_dict(row.entries)
+        entries = entries_dataframe(row.entries)
 
         # font settings
         try:
@@ -6,32 +6,20 @@ from loguru import logger
 from scipy import stats
 import numpy as np
 import pytesseract
-from PIL import Image
 import os
 import pandas as pd
 
-from ocr_pipeline.pipeline.file_preparation import save_pil_image
+from ocr_pipeline.pipeline.file_preparation import open_pil_image
 from ocr_pipeline.pipeline.helpers import tesseract_extract_dataframe, \
     image_to_data_stats, determine_human_readable_rotation_from_df, \
-    calc_line_height, run_cached
-
-
-def correct_img_rotation(file, rotation):
-    '''
-    rotate file and safe replace to original path
-    '''
-    logger.info(f"Rotate file {file} by {rotation}°")
-    rotated_img = rotate_image(file, rotation)
-    save_pil_image(rotated_img, file)
-    return [file, rotation, True]
+    calc_line_height, run_cached, resize_image
 
 
 def rotate_image(img_path, angle, expand=True):
     '''
     return rotated PIL image
     '''
-    from PIL import Image
-    img = Image.open(img_path).rotate(angle, expand=expand)
+    img = open_pil_image(img_path).rotate(angle, expand=expand)
     return img
 
 
@@ -47,7 +35,7 @@ def get_osd_info(img_path):
         string Script
         float  Script_confidence
     '''
-    img = Image.open(img_path)
+    img = open_pil_image(img_path)
     osd_info = pytesseract.image_to_osd(img)
     info = {}
     try:
@@ -122,7 +110,7 @@ def word_error_rate(ground_truth, hypothesis):
 
 
 def get_shape_accuracy(file_path, shapes=[], tess_lang='eng', tess_config=''):
-    orig_img = Image.open(file_path)
+    orig_img = open_pil_image(file_path)
 
     def _process(shape, image):
         img = image.copy()
@@ -196,75 +184,64 @@ def export_best_shapes(df_res, BEST_SHAPES_PATH):
     return best_shapes
 
 
-def apply_rotation_correction(df_corrections, APPLY_ROTATION_RESULTS_PATH,
-                              N_CPU):
+def filter_invalid_files(df, ROTATION_RESULTS_INVALID_PATH):
     '''
-    > 2.2
-    ROTATION_RESULTS_PATH - source
-    APPLY_ROTATION_RESULTS_PATH - export
-    apply rotation to files in _work and _original dir
+    split rotation results into valid and invalid (0 mlc) files
+    export the invalid ones, return the valid ones
     '''
-    fn = correct_img_rotation
-    files = list(df_corrections.file)
-    original_files = list(df_corrections.file_original)
-    add_params = [list(df_corrections.rotate)]
-    # get new files
-    col_names = ['file', 'was_rotated', 'outcome']
-
-    results = run_cached(fn, "rotation correction", files, N_CPU,
-                         col_names, cache_path=APPLY_ROTATION_RESULTS_PATH,
-                         additional_params=add_params)
-
-    results_original = run_cached(fn, "rotation org correction", original_files,
-                                  N_CPU, col_names, cache_path=None,
-                                  additional_params=add_params)
-
-    return results
-
-
-def filter_invalid_files(ROTATION_RESULTS_PATH, ROTATION_RESULTS_INVALID_PATH):
-    if not os.path.exists(ROTATION_RESULTS_INVALID_PATH):
-        # filter 0 mlc - to not be excluded from the subsequent pipeline
-        df = pd.read_csv(ROTATION_RESULTS_PATH)
-        df = df.fillna(0)
-        df_invalid = df[df.mlc == 0]
+    df = df.fillna(0)
+    df_invalid = df[df.mlc == 0]
+    if ROTATION_RESULTS_INVALID_PATH:
         df_invalid.to_csv(ROTATION_RESULTS_INVALID_PATH, index=False)
-
-        df_valid = df[df.mlc != 0]
-        df_valid.to_csv(ROTATION_RESULTS_PATH, index=False)
-    else:
-        logger.info("Filter invalid files is already applied")
+    return df[df.mlc != 0]
 
 
-def correct_img_resize(file_path, resize_p, mlc, line_height_px, length):
+def correct_img_transform(file_path, file_original, rotation, resize_p, mlc,
+                          line_height_px, length):
     '''
-    resize_p - percentage of img size
-    save resized img next to original loc
+    rotate and resize the work image and the original in one pass
+    rotation - degrees, resize_p - percentage of img size
+    both are decoded and written once, this is the last write of the
+    uploaded work and original images, so it keeps the format of the
+    extension
     '''
+    img = open_pil_image(file_path)
+    original = open_pil_image(file_original)
+    if rotation:
+        logger.info(f"Rotate file {file_path} by {rotation}°")
+        img = img.rotate(rotation, expand=True)
+        original = original.rotate(rotation, expand=True)
 
-    img = Image.open(file_path)
     width_original, height_original = img.size
-    new_size = (int(img.size[0] * resize_p), int(img.size[1] * resize_p))
-    img = img.resize(new_size)
+    img = resize_image(img, resize_p)
+    original = resize_image(original, resize_p)
     width_resized, height_resized = img.size
     img.save(file_path)
-    return [file_path, width_original, height_original, width_resized, height_resized, True, mlc, line_height_px, length]
+    original.save(file_original)
+    return [file_path, rotation, width_original, height_original,
+            width_resized, height_resized, True, mlc, line_height_px, length]
 
 
-def apply_resize_correction(df_corrections, APPLY_RESIZE_RESULTS_PATH, N_CPU):
-
-    fn = correct_img_resize
+def apply_transform_correction(df_corrections, APPLY_RESIZE_RESULTS_PATH,
+                               N_CPU):
+    '''
+    > 2.2 + 2.4
+    apply the determined rotation (column rotate, 0 if missing) and best
+    shape to files in _work and _original dir, one task per page
+    '''
+    fn = correct_img_transform
     files = list(df_corrections.file)
-    original_files = list(df_corrections.file_original)
-    add_params = [df_corrections['shape'].to_list(), df_corrections.mlc, df_corrections.line_height_px, df_corrections['length']]
-    # get new files
-    col_names = ['file', 'width_original', 'height_original', 'width_resized', 'height_resized', 'success', 'mlc', 'line_height_px', 'length']
-
-    results = run_cached(fn, "shape correction", files, N_CPU,
-                         col_names, cache_path=APPLY_RESIZE_RESULTS_PATH,
-                         additional_params=add_params)
-
-    results_original = run_cached(fn, "shape org correction", original_files,
-                                  N_CPU, col_names, cache_path=None,
-                                  additional_params=add_params)
-    return results
+    if 'rotate' in df_corrections:
+        rotations = df_corrections.rotate.fillna(0).astype(int).to_list()
+    else:
+        rotations = [0] * len(files)
+    add_params = [list(df_corrections.file_original), rotations,
+                  df_corrections['shape'].to_list(), df_corrections.mlc,
+                  df_corrections.line_height_px, df_corrections['length']]
+    col_names = ['file', 'was_rotated', 'width_original', 'height_original',
+                 'width_resized', 'height_resized', 'success', 'mlc',
+                 'line_height_px', 'length']
+
+    return run_cached(fn, "shape correction", files, N_CPU,
+                      col_names, cache_path=APPLY_RESIZE_RESULTS_PATH,
+                      additional_params=add_params)
@@ -7,17 +7,19 @@ from PIL import Image
 import pandas as pd
 import itertools
 from functools import partial
-from tesserocr import PyTessBaseAPI, RIL, iterate_level
+from tesserocr import OEM, PSM
 from tqdm import tqdm
 
 from ocr_pipeline.pipeline.analysis_computer_vision import (adaptive_binary,
      return_best_binarization_parameters)
 from ocr_pipeline.pipeline.analysis_rotation import filter_invalid_files
+from ocr_pipeline.pipeline.file_preparation import open_pil_image
 from ocr_pipeline.pipeline.helpers import (
      image_to_data_stats, determine_human_readable_rotation_from_df,
      calc_line_height, run_cached, get_list_column,
      create_dynamic_bin_size_range,
-     resize_image, tesseract_api_extract
+     resize_image, tesseract_api_extract, cached_tess_api,
+     estimate_line_height
 )
 
 
@@ -99,29 +101,83 @@ def get_max_mlc(df):
         return df.loc[0]
 
 
-def get_rotation_results_api(f, tess_lang='eng', tess_path='', max_size=3500,
-                             diff_threshold=20):
+def rotation_results_api(img, api, max_size=3500, diff_threshold=20):
     '''
-    arg f single PIL Image object
-    return to be corrected rotation information
+    arg img single PIL Image object
+    return best rotation row (rotate, mlc, length, line_height_px, human_readable_rotation)
     '''
-    with PyTessBaseAPI(oem=1, path=tess_path, lang=tess_lang) as api:
-        img = Image.open(f)
+    # 2-rotate
+    df = x_rotate([0, 180], api, img, max_size=max_size)
 
-        # 2-rotate
-        df = x_rotate([0, 180], api, img, max_size=max_size)
+    # 4-rotate: if 2-rotate difference too low
+    if get_change(df.mlc[0], df.mlc[1]) < diff_threshold:
+        df = df.append(x_rotate([90, 270], api, img, max_size=max_size), ignore_index=True)
 
-        # 4-rotate: if 2-rotate difference too low
-        if get_change(df.mlc[0], df.mlc[1]) < diff_threshold:
-            df = df.append(x_rotate([90, 270], api, img, max_size=max_size), ignore_index=True)
+    # if best out of highest 2 < diff_threshold -> no rotation
+    df = df.sort_values("mlc", ascending=False)
+    if get_change(df.iloc[0].mlc, df.iloc[1].mlc) < diff_threshold:
+        return df.loc[0]
+    # evaluate best rotation
+    return get_max_mlc(df)
 
-        # if best out of highest 2 < diff_threshold -> no rotation
-        df = df.sort_values("mlc", ascending=False)
-        if get_change(df.iloc[0].mlc, df.iloc[1].mlc) < diff_threshold:
-            best_rotation = df.loc[0]
-        else:
-            # evaluate best rotation
-            best_rotation = get_max_mlc(df)
+
+def osd_rotation_api(img, tess_path=''):
+    '''
+    single orientation and script detection pass
+    return PIL (counter-clockwise) rotation and orientation confidence
+    '''
+    with cached_tess_api(oem=OEM.TESSERACT_ONLY, path=tess_path, lang='osd',
+                         psm=PSM.OSD_ONLY) as osd_api:
+        osd_api.SetImage(img)
+        osd = osd_api.DetectOrientationScript()
+    if not osd:
+        return None, 0
+    # orient_deg is the detected clockwise rotation of the input image
+    return osd['orient_deg'], osd['orient_conf']
+
+
+def detect_rotation_api(img, api, tess_path='', max_size=3500,
+                        diff_threshold=20, detection='sweep',
+                        osd_min_confidence=3.0):
+    '''
+    detection: 'sweep' evaluates 2-4 rotations with full ocr passes,
+    'osd' uses a single osd pass plus one ocr pass for the result stats
+    and falls back to the sweep if the osd confidence is low
+    return best rotation row (rotate, mlc, length, line_height_px, human_readable_rotation)
+    '''
+    if detection == 'osd':
+        try:
+            rotate, confidence = osd_rotation_api(img, tess_path)
+        except Exception as e:
+            logger.info(f"osd failed: {e}")
+            rotate, confidence = None, 0
+        if rotate is not None and confidence >= osd_min_confidence:
+            best_rotation = x_rotate([rotate], api, img, max_size=max_size).loc[0]
+            if not np.isnan(best_rotation.mlc):
+                return best_rotation
+        logger.info(f"osd rotation {rotate} confidence {confidence} too low "
+                    f"- fallback to rotation sweep")
+    elif detection != 'sweep':
+        raise Exception(f"Invalid rotation detection '{detection}', "
+                        f"must be one of ['sweep', 'osd']")
+    return rotation_results_api(img, api, max_size=max_size,
+                                diff_threshold=diff_threshold)
+
+
+def get_rotation_results_api(f, tess_lang='eng', tess_path='', max_size=3500,
+                             diff_threshold=20, detection='sweep',
+                             osd_min_confidence=3.0):
+    '''
+    arg f path to image
+    return to be corrected rotation information
+    '''
+    with cached_tess_api(oem=1, path=tess_path, lang=tess_lang) as api:
+        img = open_pil_image(f)
+        best_rotation = detect_rotation_api(img, api, tess_path,
+                                            max_size=max_size,
+                                            diff_threshold=diff_threshold,
+                                            detection=detection,
+                                            osd_min_confidence=osd_min_confidence)
     return f, best_rotation.rotate + best_rotation.human_readable_rotation, best_rotation.mlc, best_rotation.length, best_rotation.line_height_px
 
 
@@ -135,24 +191,28 @@ def split_list(a, n):
 def pipeline_api_rotation_determination(files, ROTATION_RESULTS_PATH,
                                         ROTATION_RESULTS_INVALID_PATH, N_CPU,
                                         max_size=2500, diff_threshold=20,
-                                        tess_lang='eng', tess_path=''):
+                                        tess_lang='eng', tess_path='',
+                                        detection='sweep',
+                                        osd_min_confidence=3.0):
     '''
     tesseocr api rotation determination
+    detection - 'sweep' (2/4 orientation ocr) or 'osd' (single osd pass)
     '''
     col_names = ['file', 'rotate', 'mlc', 'length', 'line_height_px']
 
     fn = partial(get_rotation_results_api,
                  max_size=max_size,
                  diff_threshold=diff_threshold,
+                 detection=detection,
+                 osd_min_confidence=osd_min_confidence,
                  tess_lang=tess_lang,
                  tess_path=tess_path)
 
     results = run_cached(fn, "rotation determination", files, N_CPU,
                          col_names, cache_path=ROTATION_RESULTS_PATH)
 
-    if ROTATION_RESULTS_PATH and ROTATION_RESULTS_INVALID_PATH:
-        filter_invalid_files(ROTATION_RESULTS_PATH,
-                             ROTATION_RESULTS_INVALID_PATH)
+    if ROTATION_RESULTS_INVALID_PATH:
+        filter_invalid_files(results, ROTATION_RESULTS_INVALID_PATH)
 
     return results
 
@@ -162,66 +222,163 @@ def pipeline_api_rotation_determination(files, ROTATION_RESULTS_PATH,
 ##########################
 
 
-def get_shape_accuracy_api(f, shapes, tess_lang='eng', tess_config='',
-                           tess_oem=1):
+def shape_result_api(orig_img, shape, api):
     '''
-    return results as list rows eg [file, shape, mlc, length, line_height_px]
+    resize orig_img by shape and evaluate it
+    return result row eg. [shape, mlc, length, line_height_px]
+    '''
+    # resize
+    img = resize_image(orig_img, shape)
+
+    # extract
+    pairs, lines = tesseract_api_extract(img, api)
+    img.close()
+
+    # mlc, length
+    df_conf = pd.DataFrame(pairs, columns=['text', 'conf'])
+    length, txt, mlc = image_to_data_stats(df_conf)
+
+    if mlc is np.nan:
+        mlc = 0
+        length = 0
+        line_height_px = 0
+    else:
+        # line_height, human_readable_rotation
+        only_lines = get_list_column(lines, 1)
+        if len(only_lines) > 0:
+            df_lines = pd.DataFrame(only_lines)
+            df_lines = df_lines.rename(
+                columns={'w': 'width', 'h': 'height'})
+            human_readable_rotation = determine_human_readable_rotation_from_df(
+                df_lines)
+            if human_readable_rotation == 90:
+                df_lines = df_lines.rename(
+                    columns={'height': 'width', 'width': 'height'})
+            _, line_height_px = calc_line_height(df_lines)
+        else:
+            line_height_px = 0
+    return [shape, mlc, length, line_height_px]
+
+
+def shape_passes(row, benchmark, thresh_line_height=18, mlc_tolerance=0.1,
+                 length_tolerance=0.25):
     '''
-    result = []
+    True if the shape result keeps line height, mlc and length
+    close enough to the benchmark (largest) shape
+    '''
+    _, mlc, length, line_height_px = row
+    _, benchmark_mlc, benchmark_length, _ = benchmark
+    return (line_height_px >= thresh_line_height and
+            mlc >= benchmark_mlc * (1 - mlc_tolerance) and
+            length >= benchmark_length * (1 - length_tolerance))
 
-    with PyTessBaseAPI(oem=tess_oem, path=tess_config, lang=tess_lang) as api:
-        orig_img = Image.open(f)
-        for shape in tqdm(shapes):
-            # resize
-            img = resize_image(orig_img, shape)
 
-            # extract
-            pairs, lines = tesseract_api_extract(img, api)
-            img.close()
+def bisect_shapes(orig_img, shapes, api, thresh_line_height=18):
+    '''
+    coarse-to-fine shape search
+    line height grows with the scale - evaluate the largest shape as
+    benchmark, skip shapes whose predicted line height is too low and
+    bisect the rest for the smallest shape that passes the thresholds
+    '''
+    shapes = sorted(shapes)
+    benchmark = shape_result_api(orig_img, shapes[-1], api)
+    result = [benchmark]
+    if benchmark[3] <= 0:
+        return result
+
+    px_per_shape = benchmark[3] / shapes[-1]
+    candidates = [s for s in shapes[:-1]
+                  if s * px_per_shape >= thresh_line_height]
+    lo, hi = 0, len(candidates) - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        row = shape_result_api(orig_img, candidates[mid], api)
+        result.append(row)
+        if shape_passes(row, benchmark, thresh_line_height):
+            hi = mid - 1
+        else:
+            lo = mid + 1
+    logger.debug(f"shape bisect: {len(result)}/{len(shapes)} shapes evaluated")
+    return result
 
-            # mlc, length
-            df_conf = pd.DataFrame(pairs, columns=['text', 'conf'])
-            length, txt, mlc = image_to_data_stats(df_conf)
 
-            if mlc is np.nan:
-                mlc = 0
-                length = 0
-                line_height_px = 0
-            else:
-                # line_height, human_readable_rotation
-                only_lines = get_list_column(lines, 1)
-                if len(only_lines) > 0:
-                    df_lines = pd.DataFrame(only_lines)
-                    df_lines = df_lines.rename(
-                        columns={'w': 'width', 'h': 'height'})
-                    human_readable_rotation = determine_human_readable_rotation_from_df(
-                        df_lines)
-                    if human_readable_rotation == 90:
-                        df_lines = df_lines.rename(
-                            columns={'height': 'width', 'width': 'height'})
-                    _, line_height_px = calc_line_height(df_lines)
-                else:
-                    line_height_px = 0
-            result.append([f, shape, mlc, length, line_height_px])
+def filter_shapes_by_line_height(shapes, line_height_px,
+                                 thresh_line_height=18, slack=0.8):
+    '''
+    drop shapes whose estimated line height is clearly below the threshold
+    the largest shape is kept as benchmark
+    '''
+    if not line_height_px or np.isnan(line_height_px):
+        return shapes
+    largest = max(shapes)
+    return [s for s in shapes
+            if s == largest or
+            s * line_height_px >= thresh_line_height * slack]
+
+
+def shape_accuracy_api(orig_img, shapes, api, search='all',
+                       line_height_estimate=False):
+    '''
+    search: 'all' evaluates every shape, 'bisect' uses bisect_shapes
+    line_height_estimate: skip shapes by OCR-free line height estimation
+    return results as list rows eg [shape, mlc, length, line_height_px]
+    '''
+    if line_height_estimate:
+        line_height_px, n_lines = estimate_line_height(orig_img)
+        shapes = filter_shapes_by_line_height(shapes, line_height_px)
+        logger.debug(f"estimated line height: {line_height_px}, "
+                     f"lines: {n_lines}, shapes: {shapes}")
+    if search == 'bisect':
+        return bisect_shapes(orig_img, shapes, api)
+    if search != 'all':
+        raise Exception(f"Invalid shape search '{search}', "
+                        f"must be one of ['all', 'bisect']")
+    return [shape_result_api(orig_img, shape, api) for shape in tqdm(shapes)]
+
+
+def get_shape_accuracy_api(f, rotate=0, shapes=[], tess_lang='eng',
+                           tess_config='', tess_oem=1, search='all',
+                           line_height_estimate=False):
+    '''
+    rotate - determined rotation, applied in memory (the files are
+    rotated together with the resize, see apply_transform_correction)
+    return results as list rows eg [file, shape, mlc, length, line_height_px]
+    '''
+    with cached_tess_api(oem=tess_oem, path=tess_config, lang=tess_lang) as api:
+        orig_img = open_pil_image(f)
+        if rotate:
+            orig_img = orig_img.rotate(rotate, expand=True)
+        result = [[f, *row]
+                  for row in shape_accuracy_api(orig_img, shapes, api, search,
+                                                line_height_estimate)]
         orig_img.close()
     return result
 
 
 def pipeline_api_shape_determination(files, RESULTS_PATH, shapes, N_CPU,
-                                     tess_lang='eng', tess_config=''):
+                                     tess_lang='eng', tess_config='',
+                                     search='all', line_height_estimate=False,
+                                     rotations=None):
     '''
     tesseocr api shape determination
+    search - 'all' (every shape) or 'bisect' (coarse-to-fine)
+    rotations - per file rotation not yet applied to the files
     '''
     col_names = ['file', 'shape', 'mlc', 'length', 'line_height_px']
 
     fn = partial(get_shape_accuracy_api,
                  shapes=shapes,
+                 search=search,
+                 line_height_estimate=line_height_estimate,
                  tess_lang=tess_lang,
                  tess_oem=1,
                  tess_config=tess_config)
 
+    if rotations is None:
+        rotations = [0] * len(files)
     return run_cached(fn, "shape determination", files, N_CPU,
-                      col_names, cache_path=RESULTS_PATH, flatten=True)
+                      col_names, cache_path=RESULTS_PATH, flatten=True,
+                      additional_params=[rotations])
 
 
 ##########################
@@ -229,49 +386,140 @@ def pipeline_api_shape_determination(files, RESULTS_PATH, shapes, N_CPU,
 ##########################
 
 
-def get_adaptive_binarization_api(file, line_height, adaptive_cs,
-                                  adaptive_methods, size_ranges,
-                                  tess_lang='eng', tess_config='',
-                                  tess_oem=1):
+def binarization_accuracy_api(img, size, c, method, api):
     '''
-    data: list object of image paths, sizes, cs, method eg. [['car.png', 71, 10, 1],['car.png', 91, 10, 0]]
-    return results as list rows eg. [file, size, c, method, cv_adaptive_sizes, line_height_px, mlc, length, time]
+    binarize img with a single parameter combination and evaluate it
+    return result row eg. [size, c, method, mlc, length, line_height_px]
     '''
+    # binarization
+    curr_img = adaptive_binary(img, size, c, method)
+    curr_img = Image.fromarray(curr_img)
 
-    data = []
-    with PyTessBaseAPI(oem=tess_oem, path=tess_config, lang=tess_lang) as api:
-        bin_size = create_dynamic_bin_size_range(line_height, size_ranges)
-        img = Image.open(file)
+    # extract
+    pairs, lines = tesseract_api_extract(curr_img, api)
+    curr_img.close()
 
-        # baseline without binarization
-        pairs, lines = tesseract_api_extract(img, api)
-        df_lines = pd.DataFrame([line[1] for line in lines])
-        df_conf = pd.DataFrame(pairs, columns=['text', 'conf'])
-        length, _, mlc = image_to_data_stats(df_conf)
-        data.append([file, None, None, None, mlc, length, np.nan])
+    df_lines = pd.DataFrame([line[1] for line in lines])
+
+    try:
+        df_lines = df_lines.rename(columns={'w': 'width', 'h': 'height'})
+        _, line_height_px = calc_line_height(df_lines)
+    except Exception as e:
+        line_height_px = np.nan
 
-        for size, c, method in tqdm(itertools.product(bin_size, adaptive_cs, adaptive_methods)):
-            # binarization
-            curr_img = adaptive_binary(img, size, c, method)
-            curr_img = Image.fromarray(curr_img)
+    # mlc, length
+    df_conf = pd.DataFrame(pairs, columns=['text', 'conf'])
+    length, _, mlc = image_to_data_stats(df_conf)
 
-            # extract
-            pairs, lines = tesseract_api_extract(curr_img, api)
-            curr_img.close()
+    return [size, c, method, mlc, length, line_height_px]
 
-            df_lines = pd.DataFrame([line[1] for line in lines])
 
-            try:
-                df_lines = df_lines.rename(columns={'w': 'width', 'h': 'height'})
-                _, line_height_px = calc_line_height(df_lines)
-            except Exception as e:
-                line_height_px = np.nan
+def grid_search(img, candidates, api):
+    '''
+    evaluate every candidate on the full page
+    '''
+    return [binarization_accuracy_api(img, size, c, method, api)
+            for size, c, method in tqdm(candidates)]
 
-            # mlc, length
-            df_conf = pd.DataFrame(pairs, columns=['text', 'conf'])
-            length, _, mlc = image_to_data_stats(df_conf)
 
-            data.append([file, size, c, method, mlc, length, line_height_px])
+def proxy_crop(img, fraction):
+    '''
+    return the horizontal band of img with height fraction
+    that contains the most grayscale activity (text)
+    '''
+    if fraction >= 1:
+        return img
+    gray = np.asarray(img, dtype=np.float32)
+    if gray.ndim == 3:
+        gray = gray.mean(axis=2)
+    band = max(1, int(gray.shape[0] * fraction))
+    window = np.convolve(gray.std(axis=1), np.ones(band), mode='valid')
+    top = int(np.argmax(window))
+    return img.crop((0, top, img.size[0], top + band))
+
+
+def rank_binarization_results(results):
+    '''
+    sort result rows like return_best_binarization_parameters:
+    rows above the negative length std boundary first, then by mlc
+    '''
+    df = pd.DataFrame(results, columns=['size', 'c', 'method', 'mlc',
+                                        'length', 'line_height_px'])
+    df[['mlc', 'length']] = df[['mlc', 'length']].fillna(0)
+    lower_limit = np.mean(df['length']) - np.std(df['length']) - 1e-5
+    df['valid'] = df['length'] > lower_limit
+    return df.sort_values(['valid', 'mlc'], ascending=False).index.to_list()
+
+
+def successive_halving_search(img, candidates, api,
+                              proxy_fractions=(0.15, 0.3), eta=2):
+    '''
+    score candidates on cropped proxies of increasing size and keep the
+    best 1/eta after each round, only the survivors get a full-page pass
+    '''
+    survivors = list(candidates)
+    for fraction in proxy_fractions:
+        if len(survivors) <= eta:
+            break
+        proxy = proxy_crop(img, fraction)
+        results = [binarization_accuracy_api(proxy, size, c, method, api)
+                   for size, c, method in survivors]
+        n_keep = max(eta, len(survivors) // eta)
+        survivors = [survivors[i]
+                     for i in rank_binarization_results(results)[:n_keep]]
+        logger.debug(f"proxy {fraction}: {len(survivors)} candidates left")
+    return grid_search(img, survivors, api)
+
+
+BINARIZATION_SEARCH = {
+    'grid': grid_search,
+    'halving': successive_halving_search
+}
+
+
+def adaptive_binarization_api(img, line_height, adaptive_cs, adaptive_methods,
+                              size_ranges, api, search='grid',
+                              line_height_estimate=False):
+    '''
+    img: PIL image to be binarized
+    search: candidate search strategy of BINARIZATION_SEARCH
+    line_height_estimate: OCR-free line height if the given one is invalid
+    return results as list rows eg. [size, c, method, mlc, length, line_height_px]
+    '''
+    if search not in BINARIZATION_SEARCH:
+        raise Exception(f"Invalid binarization search '{search}', "
+                        f"must be one of {list(BINARIZATION_SEARCH)}")
+    data = []
+    if line_height_estimate and not (line_height >= 10):
+        line_height, _ = estimate_line_height(img)
+        logger.debug(f"estimated line height: {line_height}")
+    bin_size = create_dynamic_bin_size_range(line_height, size_ranges)
+
+    # baseline without binarization
+    pairs, lines = tesseract_api_extract(img, api)
+    df_conf = pd.DataFrame(pairs, columns=['text', 'conf'])
+    length, _, mlc = image_to_data_stats(df_conf)
+    data.append([None, None, None, mlc, length, np.nan])
+
+    candidates = itertools.product(bin_size, adaptive_cs, adaptive_methods)
+    data.extend(BINARIZATION_SEARCH[search](img, candidates, api))
+    return data
+
+
+def get_adaptive_binarization_api(file, line_height, adaptive_cs,
+                                  adaptive_methods, size_ranges,
+                                  tess_lang='eng', tess_config='',
+                                  tess_oem=1, search='grid',
+                                  line_height_estimate=False):
+    '''
+    data: list object of image paths, sizes, cs, method eg. [['car.png', 71, 10, 1],['car.png', 91, 10, 0]]
+    return results as list rows eg. [file, size, c, method, mlc, length, line_height_px]
+    '''
+    with cached_tess_api(oem=tess_oem, path=tess_config, lang=tess_lang) as api:
+        img = open_pil_image(file)
+        data = [[file, *row] for row in adaptive_binarization_api(
+            img, line_height, adaptive_cs, adaptive_methods, size_ranges, api,
+            search=search, line_height_estimate=line_height_estimate)]
         img.close()
     return data
 
@@ -297,14 +545,18 @@ def pipeline_api_binarization_gridsearch(valid_files_data,
                                          cv_dynamic_size_ranges, cv_adaptive_cs,
                                          cv_adaptive_methods, RESULTS_PATH,
                                          N_CPU, tess_lang='eng',
-                                         tess_config=''):
+                                         tess_config='', search='grid',
+                                         line_height_estimate=False):
     '''
     tesseocr api binarization params determination
+    search - 'grid' (all combinations) or 'halving' (successive halving)
     '''
     fn = partial(get_adaptive_binarization_api,
                  tess_lang=tess_lang,
                  tess_config=tess_config,
                  tess_oem=1,
+                 search=search,
+                 line_height_estimate=line_height_estimate,
                  adaptive_cs=cv_adaptive_cs,
                  adaptive_methods=cv_adaptive_methods,
                  size_ranges=cv_dynamic_size_ranges,
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from collections import OrderedDict
+import os
+import tempfile
+
+from enchant.checker import SpellChecker
+from loguru import logger
+from symspellpy import SymSpell
+
+
+class DictionaryRegistry:
+    '''
+    process-wide registry of loaded spelling dictionaries
+    symspell indices are built once from the word list and snapshotted
+    (uncompressed pickle) to snapshot_dir, later loads read the snapshot
+    least recently used symspell indices are dropped once their estimated
+    size (snapshot size) exceeds memory_budget (MB, 0 = unlimited), the
+    most recently used one is always kept
+    enchant checkers are kept per dictionary
+    '''
+
+    def __init__(self, dictionary_dir='/app/symspell_dictionaries',
+                 snapshot_dir='', memory_budget=0,
+                 max_dictionary_edit_distance=2, prefix_length=7):
+        self.dictionary_dir = dictionary_dir
+        self.snapshot_dir = snapshot_dir or os.path.join(
+            tempfile.gettempdir(), 'symspell_snapshots')
+        self.memory_budget = memory_budget * 1024 * 1024
+        self.max_dictionary_edit_distance = max_dictionary_edit_distance
+        self.prefix_length = prefix_length
+        self.symspells = OrderedDict()
+        self.checkers = {}
+
+    def symspell(self, name):
+        '''
+        loaded SymSpell of word list name (e.g. de-100k.txt)
+        '''
+        if name in self.symspells:
+            self.symspells.move_to_end(name)
+            return self.symspells[name][0]
+
+        sym_spell = SymSpell(
+            max_dictionary_edit_distance=self.max_dictionary_edit_distance,
+            prefix_length=self.prefix_length)
+        dictionary_path = os.path.join(self.dictionary_dir, name)
+        snapshot_path = self.snapshot_path(dictionary_path)
+        if snapshot_path and os.path.exists(snapshot_path):
+            logger.info(f'load symspell snapshot {snapshot_path}')
+            sym_spell.load_pickle(snapshot_path, compressed=False)
+        else:
+            logger.info(f'init symspell {dictionary_path}')
+            sym_spell.load_dictionary(dictionary_path, term_index=0,
+                                      count_index=1)
+            self.save_snapshot(sym_spell, snapshot_path)
+
+        size = os.path.getsize(snapshot_path) \
+            if snapshot_path and os.path.exists(snapshot_path) else 0
+        self.symspells[name] = (sym_spell, size)
+        self.evict()
+        return sym_spell
+
+    def enchant(self, name):
+        '''
+        enchant SpellChecker of dictionary name (e.g. de_DE)
+        '''
+        if name not in self.checkers:
+            self.checkers[name] = SpellChecker(name)
+        return self.checkers[name]
+
+    def snapshot_path(self, dictionary_path):
+        '''
+        snapshot location, depends on word list version and index parameters
+        '''
+        if not os.path.exists(dictionary_path):
+            return None
+        stat = os.stat(dictionary_path)
+        return os.path.join(
+            self.snapshot_dir,
+            f"{os.path.basename(dictionary_path)}."
+            f"{self.max_dictionary_edit_distance}-{self.prefix_length}."
+            f"{stat.st_size}-{stat.st_mtime_ns}.pickle")
+
+    def save_snapshot(self, sym_spell, snapshot_path):
+        if not snapshot_path:
+            return
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+            sym_spell.save_pickle(tmp_path, compressed=False)
+            os.replace(tmp_path, snapshot_path)
+        except OSError as e:
+            logger.info(f'symspell snapshot not saved: {e}')
+
+    def evict(self):
+        if not self.memory_budget:
+            return
+        while len(self.symspells) > 1 and \
+                sum(size for _, size in self.symspells.values()) > self.memory_budget:
+            name, _ = self.symspells.popitem(last=False)
+            logger.info(f'drop symspell {name} (memory budget)')
+
+
+_dictionary_registry = None
+
+
+def configure_dictionary_registry(dictionary_dir='/app/symspell_dictionaries',
+                                  snapshot_dir='', memory_budget=0):
+    global _dictionary_registry
+    _dictionary_registry = DictionaryRegistry(dictionary_dir, snapshot_dir,
+                                              memory_budget)
+    return _dictionary_registry
+
+
+def get_dictionary_registry():
+    global _dictionary_registry
+    if _dictionary_registry is None:
+        _dictionary_registry = DictionaryRegistry()
+    return _dictionary_registry
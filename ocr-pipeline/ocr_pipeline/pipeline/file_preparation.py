@@ -5,6 +5,7 @@ from functools import partial
 import shutil
 import os
 
+import cv2
 import imageio
 import numpy as np
 import pandas as pd
@@ -17,12 +18,80 @@ import fitz
 from pdf2image import convert_from_path, pdfinfo_from_path
 
 
+INTERMEDIATE_CODECS = ['png', 'png1', 'tiff', 'npy']
+NPY_MAGIC = b'\x93NUMPY'
+
+_intermediate_codec = 'png'
+_intermediate_dpi = 300
+
+
+def check_intermediate_codec(codec):
+    if codec not in INTERMEDIATE_CODECS:
+        raise Exception(f"Invalid intermediate image codec '{codec}', must be one of {INTERMEDIATE_CODECS}")
+    return codec
+
+
+def configure_intermediate_codec(codec='png', dpi=300):
+    '''
+    process-wide codec of work files that are rewritten between stages
+    and never uploaded
+    png - PIL default, png1 - png with compress_level=1,
+    tiff - uncompressed tiff, npy - raw numpy array (memory-mapped on read)
+    dpi - resolution reported for npy files, which carry no metadata
+    '''
+    global _intermediate_codec, _intermediate_dpi
+    _intermediate_codec = check_intermediate_codec(codec)
+    _intermediate_dpi = dpi
+
+
+def is_npy_file(img_path):
+    with open(img_path, 'rb') as f:
+        return f.read(len(NPY_MAGIC)) == NPY_MAGIC
+
+
 def open_pil_image(img_path):
+    '''
+    open an image of any codec, work files keep their names whatever codec
+    wrote them, so the codec is detected from the content
+    '''
+    if is_npy_file(img_path):
+        img = Image.fromarray(np.load(img_path, mmap_mode='r'))
+        img.info['dpi'] = (_intermediate_dpi, _intermediate_dpi)
+        return img
     return Image.open(img_path)
 
 
-def save_pil_image(pil_img, to_path):
-    pil_img.save(to_path)
+def read_gray_image(img_path):
+    '''
+    cv2.imread(img_path, 0) that also reads npy work files
+    '''
+    if is_npy_file(img_path):
+        return np.asarray(open_pil_image(img_path).convert('L'))
+    return cv2.imread(img_path, 0)
+
+
+def save_pil_image(pil_img, to_path, intermediate=False, dpi=None):
+    '''
+    intermediate - the file is rewritten by a later stage and never
+    uploaded, write it with the configured intermediate codec instead of
+    the format of its extension
+    '''
+    params = {} if dpi is None else {'dpi': (dpi, dpi)}
+    codec = _intermediate_codec if intermediate else None
+    if codec == 'npy':
+        if pil_img.mode == 'P':
+            pil_img = pil_img.convert('RGB')
+        # replace instead of truncate, the file may still be memory-mapped
+        tmp_path = f"{to_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(pil_img))
+        os.replace(tmp_path, to_path)
+    elif codec == 'tiff':
+        pil_img.save(to_path, format='TIFF', **params)
+    elif codec == 'png1':
+        pil_img.save(to_path, format='PNG', compress_level=1, **params)
+    else:
+        pil_img.save(to_path, **params)
     #logger.info(os.path.getsize(to_path))
 
 
@@ -258,61 +327,213 @@ def split_pdf_into_images(path, to_format="png", dpi=300):
         raise Exception(f"file {path} is not a .pdf")
 
 
-def raw_transform(img_path, to_format='png'):
+def pdf_page_has_text(page):
+    '''
+    cheap text layer candidate check for planning: the page references
+    fonts, the words are only extracted when the page is processed
+    '''
+    return len(page.get_fonts()) > 0
+
+
+def is_scanned_pdf_page(page, min_image_coverage=0.9):
+    '''
+    scan with an ocr layer: a page-filling image and only invisible text
+    (render mode 3), the old ocr layer is not reused
+    '''
+    page_area = abs(page.rect)
+    if not page_area:
+        return False
+    full_page_image = any(
+        abs(fitz.Rect(image['bbox']) & page.rect) >= page_area * min_image_coverage
+        for image in page.get_image_info())
+    if not full_page_image:
+        return False
+    return all(span['type'] == 3 for span in page.get_texttrace())
+
+
+def pdf_text_layer_words(page, min_words=5, min_alnum_ratio=0.5):
+    '''
+    return the words (x0, y0, x1, y1, text, ...) of a fitz page if the page
+    has a usable text layer, empty list for image-only and scanned pages
+    '''
+    words = page.get_text("words")
+    if len(words) < min_words:
+        return []
+    text = "".join(word[4] for word in words)
+    if sum(c.isalnum() for c in text) < len(text) * min_alnum_ratio:
+        return []
+    if is_scanned_pdf_page(page):
+        return []
+    return words
+
+
+def plan_pdf_pages(path, to_format="png", text_layer=False):
+    '''
+    streaming alternative to split_pdf_into_images
+    return one row per page with the page image path (same naming as
+    split_pdf_into_images) without rendering it - the page is rendered
+    later by render_pdf_page when it is processed
+    text_layer - mark pages that may have a usable text layer, the layer
+    is checked once by pdf_text_layer_dataframe when the page is processed
+    '''
+    if os.path.splitext(os.path.basename(path))[1][1:] != 'pdf':
+        raise Exception(f"file {path} is not a .pdf")
+    f_path = os.path.split(path)[0]
+    f_name = os.path.splitext(os.path.basename(path))[0]
+
+    with fitz.open(path) as document:
+        max_pages = document.page_count
+        has_text_layer = [text_layer and pdf_page_has_text(page)
+                          for page in document]
+    logger.info(f"pdf pages to be streamed: {max_pages}, "
+                f"text layer candidates: {sum(has_text_layer)}")
+
+    digits = len(str(max_pages))
+    return [(True, f"{f_path}/{f_name}-{str(page + 1).zfill(digits)}.{to_format}",
+             None, None, None, path, page, has_text_layer[page])
+            for page in range(max_pages)]
+
+
+def render_pdf_page(path, page, dpi=300):
+    '''
+    render a single pdf page straight to a RGB PIL image
+    '''
+    with fitz.open(path) as document:
+        zoom = dpi / 72
+        pix = document[page].get_pixmap(matrix=fitz.Matrix(zoom, zoom),
+                                        alpha=False)
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    img.info['dpi'] = (dpi, dpi)
+    return img
+
+
+def pdf_text_layer_dataframe(path, page, dpi=300):
+    '''
+    word boxes of the pdf text layer in the pixel space of render_pdf_page
+    with the level 5 image_to_data columns (conf 100)
+    return None if the page has no usable text layer (pdf_text_layer_words)
+    '''
+    zoom = dpi / 72
+    with fitz.open(path) as document:
+        fitz_page = document[page]
+        words = pdf_text_layer_words(fitz_page)
+        if not words:
+            return None
+        matrix = fitz_page.rotation_matrix * fitz.Matrix(zoom, zoom)
+        rows = []
+        for word in words:
+            rect = fitz.Rect(word[:4]) * matrix
+            rows.append([5, int(rect.x0), int(rect.y0), int(rect.width),
+                         int(rect.height), 100.0, word[4]])
+    return pd.DataFrame(rows, columns=['level', 'left', 'top', 'width',
+                                       'height', 'conf', 'text'])
+
+
+def pipeline_plan_pdf_pages(df_files, to_format='png', text_layer=False):
+    '''
+    df_files - get_valid_files pd dataframe
+    replace pdf rows by their planned page rows with source pdf and page index
+    '''
+    selector = df_files.extension == '.pdf'
+    df_pdf = df_files[selector]
+    df_files = df_files[~selector].assign(source=None, page=None,
+                                          text_layer=False)
+
+    pages = [
+        (out_file, os.path.splitext(out_file)[1], master_copy,
+         production_master, access_copy, source, page, page_text_layer)
+        for f in df_pdf.file
+        for _, out_file, master_copy, production_master, access_copy,
+        source, page, page_text_layer in plan_pdf_pages(f, to_format,
+                                                        text_layer)
+    ]
+    return df_files.append(pd.DataFrame(pages, columns=[
+        'file',
+        'extension',
+        'master_copy',
+        'production_master',
+        'access_copy',
+        'source',
+        'page',
+        'text_layer'
+    ]), ignore_index=True)
+
+
+RAW_SCALING_EXTENSIONS = ['.arw']  # raw-scaling for selected raw types
+
+
+def raw_postprocess(raw, half_size, output_bps):
+    return raw.postprocess(half_size=half_size,
+                           output_color=rawpy.ColorSpace(0),
+                           no_auto_bright=False,
+                           use_camera_wb=True,
+                           use_auto_wb=False,
+                           user_wb=None,
+                           output_bps=output_bps,
+                           bright=1.0,
+                           dcb_enhance=False,
+                           four_color_rgb=False
+                           )
+
+
+def raw_derive_8bit(img_16bit):
+    '''
+    half size 8 bit working image of a 16 bit demosaiced raw image
+    mean of each 2x2 block, scaled from 16 to 8 bit by a shift (sum >> 10)
+    '''
+    height, width = img_16bit.shape[0] // 2, img_16bit.shape[1] // 2
+    blocks = img_16bit[:height * 2, :width * 2].reshape(
+        height, 2, width, 2, *img_16bit.shape[2:])
+    return (blocks.sum(axis=(1, 3), dtype=np.uint32) >> 10).astype(np.uint8)
+
+
+def raw_transform(img_path, to_format='png', png_compress_level=1,
+                  tiff_compress_level=0, jpeg_quality=75):
     '''
     > export ARW, DNG file as to_format
     *can adapt code to export other raw extensions
+    the raw file is demosaiced once: at half size and 8 bit for the working
+    image only, at full size and 16 bit if scalings are exported (the 8 bit
+    image is derived from it)
+    png_compress_level, tiff_compress_level, jpeg_quality - encoder effort
     '''
     f_name = get_filename(img_path)
     f_path, extension = os.path.split(img_path)
     extension = extension[-4:]
     output_filename = f"{f_path}/{f_name}.{to_format}"
+    scaling = extension.lower() in RAW_SCALING_EXTENSIONS
+    img_converted_16bit = None
     try:
         with rawpy.imread(img_path) as raw:
-            # load as 8 bit
-            img_converted_8bit = raw.postprocess(half_size=True,
-                                                 output_color=rawpy.ColorSpace(0),
-                                                 no_auto_bright=False,
-                                                 use_camera_wb=True,
-                                                 use_auto_wb=False,
-                                                 user_wb=None,
-                                                 output_bps=8,
-                                                 bright=1.0,
-                                                 dcb_enhance=False,
-                                                 four_color_rgb=False
-                                                 )
-            # load as 16 bit
-            img_converted_16bit = raw.postprocess(half_size=False,
-                                                  output_color=rawpy.ColorSpace(0),
-                                                  no_auto_bright=False,
-                                                  use_camera_wb=True,
-                                                  use_auto_wb=False,
-                                                  user_wb=None,
-                                                  output_bps=16,
-                                                  bright=1.0,
-                                                  dcb_enhance=False,
-                                                  four_color_rgb=False
-                                                  )
-
-        imageio.imsave(output_filename, img_converted_8bit, compress_level=9)
+            if scaling:
+                img_converted_16bit = raw_postprocess(raw, False, 16)
+            else:
+                img_converted_8bit = raw_postprocess(raw, True, 8)
+        if scaling:
+            img_converted_8bit = raw_derive_8bit(img_converted_16bit)
+
+        imageio.imsave(output_filename, img_converted_8bit,
+                       compress_level=png_compress_level)
 
     except Exception as e:
         logger.warning(
             f"Could not convert file {img_path} to {to_format} due to {e}")
         return False, output_filename, None, None, None
 
-    scaling_extensions = ['.arw']  # raw-scaling for selected raw types
-    if extension.lower() not in scaling_extensions:
+    if not scaling:
         logger.info(f"skipping raw scaling for extension {extension}")
         return True, output_filename, None, None, None
 
     # raw-scaleing
-    scale_success, scale_jpg, scale_tiff, scale_tiff = create_raw_scaling(
-        img_path,
-        img_converted_8bit,
-        img_converted_16bit,
-        None)
-    return scale_success, output_filename, scale_jpg, scale_tiff, scale_tiff
+    scale_success, master_copy, production_master, access_copy = \
+        create_raw_scaling(img_path,
+                           img_converted_8bit,
+                           img_converted_16bit,
+                           None,
+                           tiff_compress_level=tiff_compress_level,
+                           jpeg_quality=jpeg_quality)
+    return scale_success, output_filename, master_copy, production_master, \
+        access_copy
 
 
 def pipeline_split_pdf(df_files, TRANSFORM_FILE_PDF, N_CPU,
@@ -332,14 +553,18 @@ def pipeline_split_pdf(df_files, TRANSFORM_FILE_PDF, N_CPU,
 
 
 def pipeline_transform_raw(df_files, TRANSFORM_FILE_RAW, N_CPU,
-                           to_format='png'):
+                           to_format='png', png_compress_level=1,
+                           tiff_compress_level=0, jpeg_quality=75):
     '''
     df_files - get_valid_files pd dataframe
     TRANSFORM_FILE_RAW - export success
     '''
     raw_extensions = ['.arw', '.dng']
 
-    return convert_file_format(raw_transform, df_files,
+    fn = partial(raw_transform, png_compress_level=png_compress_level,
+                 tiff_compress_level=tiff_compress_level,
+                 jpeg_quality=jpeg_quality)
+    return convert_file_format(fn, df_files,
                                df_files.extension.isin(raw_extensions),
                                ".RAW",
                                to_format, N_CPU, out_file=TRANSFORM_FILE_RAW,
@@ -391,13 +616,15 @@ def merge_df(left, right):
 
 
 def create_raw_scaling(file_path, img_converted_8bit,
-                       img_converted_16bit, RAW_SCALINGS_DIR=None):
+                       img_converted_16bit, RAW_SCALINGS_DIR=None,
+                       tiff_compress_level=0, jpeg_quality=75):
     '''
     raw file scaling
     arg img_converted_8bit - cached raw file
     arg img_converted_16bit - cached raw file
     given raw file from arg file_path
-        .TIFF 2x
+        .TIFF 2x (written once, the production master is a hard link of
+        the identical master copy)
         .JPG 1x
     to directory arg RAW_SCALINGS_DIR
     '''
@@ -410,15 +637,30 @@ def create_raw_scaling(file_path, img_converted_8bit,
         to_format = 'tiff'
         master_copy = f"{RAW_SCALINGS_DIR}{filename_wo_extension}_MC.{to_format}"
         production_master = f"{RAW_SCALINGS_DIR}{filename_wo_extension}_PM.{to_format}"
-        imageio.imsave(master_copy, img_converted_16bit)
-        imageio.imsave(production_master, img_converted_16bit)
+        # tifffile takes the compression as write metadata
+        with imageio.get_writer(master_copy, format='TIFF') as writer:
+            writer.append_data(img_converted_16bit,
+                               {'compress': tiff_compress_level})
+        link_file(master_copy, production_master)
 
         to_format = 'jpg'
         access_copy = f"{RAW_SCALINGS_DIR}{filename_wo_extension}_AC.{to_format}"
-        imageio.imsave(access_copy, img_converted_8bit)
+        imageio.imsave(access_copy, img_converted_8bit, quality=jpeg_quality)
 
         return True, Path(master_copy), Path(production_master), Path(
             access_copy)
     except Exception as e:
         logger.warning(f"Could not convert file {file_path} due to {e}")
         return False, None, None, None
+
+
+def link_file(src, dst):
+    '''
+    hard link dst to src, copy where linking is not possible
+    '''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
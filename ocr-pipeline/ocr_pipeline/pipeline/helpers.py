@@ -1,14 +1,15 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import subprocess
 import os.path
 import sys
-import shutil
 import csv
 import os
 import itertools
 import multiprocessing
+import shlex
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import cv2
 from loguru import logger
@@ -16,6 +17,15 @@ import numpy as np
 import pandas as pd
 import pytesseract
 from multiprocessing import get_context
+from tesserocr import PyTessBaseAPI, RIL, iterate_level
+
+from ocr_pipeline.pipeline.dictionary_registry import \
+    configure_dictionary_registry
+from ocr_pipeline.pipeline.file_preparation import \
+    configure_intermediate_codec, read_gray_image
+from ocr_pipeline.pipeline.stage_store import StageStore, params_hash, \
+    frame_hash
+from ocr_pipeline.pipeline.suggestion_cache import configure_suggestion_cache
 
 
 def resize_image(img, shape):
@@ -37,11 +47,116 @@ def tesseract_api_extract(img, api) -> (list, list):
         return [], []
 
 
+_tess_api_cache = OrderedDict()
+_tess_api_cache_size = 4
+
+
+def set_tess_api_cache_size(size):
+    '''
+    max number of initialized tesseract apis kept per worker process
+    '''
+    global _tess_api_cache_size
+    _tess_api_cache_size = max(1, size)
+
+
+def init_worker(tess_api_cache_size=4, dictionary_args=(),
+                suggestion_cache_args=(), intermediate_codec_args=()):
+    '''
+    worker process initializer - pages are processed in parallel
+    processes, so opencv should not spawn additional threads per page
+    (tesseract is limited by spawn_worker_pool, the variable is kept for
+    tesseract subprocesses of the worker)
+    dictionary_args, suggestion_cache_args - arguments of
+    configure_dictionary_registry and configure_suggestion_cache for the
+    worker-local spelling correction
+    intermediate_codec_args - arguments of configure_intermediate_codec
+    '''
+    cv2.setNumThreads(1)
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    set_tess_api_cache_size(tess_api_cache_size)
+    configure_dictionary_registry(*dictionary_args)
+    configure_suggestion_cache(*suggestion_cache_args)
+    configure_intermediate_codec(*intermediate_codec_args)
+
+
+@contextmanager
+def cached_tess_api(path='', lang='eng', oem=1, psm=None):
+    '''
+    worker-local registry of initialized PyTessBaseAPI objects
+    keyed by tessdata path, language set, engine and page segmentation mode
+    an api is taken out of the registry while it is in use, so nested
+    calls (e.g. the osd api inside a page api) never end an api that is
+    still checked out; least recently used idle apis are ended once the
+    cache size is exceeded
+    the api is cleared after use instead of a full re-init
+    '''
+    key = (path, lang, oem, psm)
+    api = _tess_api_cache.pop(key, None)
+    if api is None:
+        if psm is None:
+            api = PyTessBaseAPI(oem=oem, path=path, lang=lang)
+        else:
+            api = PyTessBaseAPI(oem=oem, path=path, lang=lang, psm=psm)
+    try:
+        yield api
+    finally:
+        api.Clear()
+        previous = _tess_api_cache.pop(key, None)
+        if previous is not None:
+            previous.End()
+        _tess_api_cache[key] = api
+        while len(_tess_api_cache) > _tess_api_cache_size:
+            _, evicted = _tess_api_cache.popitem(last=False)
+            evicted.End()
+
+
 def tesseract_extract_dataframe(img_binary, lang='eng', config=''):
     return pytesseract.image_to_data(img_binary, lang=lang, config=config,
                                      output_type='data.frame')
 
 
+def parse_tess_config(config=''):
+    '''
+    split a tesseract cli config string (as used with pytesseract)
+    return tessdata path, oem, psm and dict of -c variables
+    '''
+    path, oem, psm, variables = '', 1, None, {}
+    args = shlex.split(config)
+    for i, arg in enumerate(args[:-1]):
+        if arg == '--tessdata-dir':
+            path = args[i + 1]
+        elif arg == '--oem':
+            oem = int(args[i + 1])
+        elif arg == '--psm':
+            psm = int(args[i + 1])
+        elif arg == '-c' and '=' in args[i + 1]:
+            key, value = args[i + 1].split('=', 1)
+            variables[key] = value
+    return path, oem, psm, variables
+
+
+def tesseract_api_extract_dataframe(img, api):
+    '''
+    in-process alternative to tesseract_extract_dataframe
+    return level 5 (word) boxes dataframe with the image_to_data columns
+    level, left, top, width, height, conf, text
+    conf is truncated to int like in the tesseract 4 tsv renderer
+    '''
+    api.SetImage(img)
+    api.Recognize()
+    rows = []
+    for word in iterate_level(api.GetIterator(), RIL.WORD):
+        box = word.BoundingBox(RIL.WORD)
+        if box is None:
+            continue
+        left, top, right, bottom = box
+        rows.append([5, left, top, right - left, bottom - top,
+                     int(word.Confidence(RIL.WORD)),
+                     word.GetUTF8Text(RIL.WORD)])
+    return pd.DataFrame(rows, columns=['level', 'left', 'top', 'width',
+                                       'height', 'conf', 'text'])
+
+
 def get_new_files_to_be_processed(path, col_names, index_col, all_files):
     '''
     path (str) - to datafile
@@ -106,7 +221,7 @@ def check_if_file_in_list(file_path, gs_list):
 def job(path, arg_2, arg_3, arg_4):
     logger.debug(f"{arg_2[0]}, {arg_3[0]}, {arg_4}")
 
-    img_bin_adapt = cv2.imread(path, 0)
+    img_bin_adapt = read_gray_image(path)
     if arg_4[0] == 0:
         logger.debug("threshold mode 'y'")
         img_bin_adapt = cv2.adaptiveThreshold(img_bin_adapt,255,cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 15, 15)
@@ -131,51 +246,170 @@ def get_list_column(data, col):
     return [item[col] for item in data]
 
 
-def run_cached(fn, name, files, n_cpu, col_names, additional_params=[],
-               cache_path=None, flatten=False):
-
-    if cache_path is not None and os.path.exists(cache_path):
-        data = pd.read_csv(cache_path, header=0)
-        cached_files = set(data['file'])
-        indices = [i for i, f in enumerate(files)  if f not in cached_files]
-        files = [files[i] for i in indices]
-        additional_params = [[data[i] for i in indices]
-                             for data in additional_params]
-        logger.info('load existing data..')
-    else:
-        data = pd.DataFrame(columns=col_names)
+_worker_pool = None
+_worker_batch_size = 0
+_worker_initargs = ()
+_stage_store = None
 
-    #if len(files) > n_cpu:
-    #n_cpu = min(len(files), n_cpu)
 
-    logger.info(f'{name} files: {len(files)}, cpus: {n_cpu}')
-    if len(files) > 0:
-        #if n_cpu > 1:
-        #    pool = multiprocessing.Pool(processes=n_cpu)
-        #    mapper = pool.starmap
-        #else:
-        #    mapper = itertools.starmap
-        #    pool = None
+def set_worker_initargs(initargs):
+    '''
+    init_worker arguments of the per-call pool run_cached falls back to
+    when no long-lived pool was created (standalone Pipeline use)
+    '''
+    global _worker_initargs
+    _worker_initargs = tuple(initargs)
+
+
+def spawn_worker_pool(n_cpu, initializer=None, initargs=()):
+    '''
+    spawn pool whose workers run tesseract single threaded - pages are
+    already processed in parallel processes, OMP_THREAD_LIMIT is read when
+    the spawned interpreter loads tesseract, before the initializer runs,
+    so it is set in the environment the workers are started with
+    '''
+    omp_thread_limit = os.environ.get('OMP_THREAD_LIMIT')
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    try:
+        return get_context("spawn").Pool(processes=n_cpu,
+                                         initializer=initializer,
+                                         initargs=initargs)
+    finally:
+        if omp_thread_limit is None:
+            del os.environ['OMP_THREAD_LIMIT']
+        else:
+            os.environ['OMP_THREAD_LIMIT'] = omp_thread_limit
+
+
+def create_worker_pool(n_cpu, batch_size=0, initializer=None, initargs=()):
+    '''
+    create the long-lived worker pool that is reused by run_cached
+    for all stages and messages instead of a new pool per stage call
+    batch_size - number of files per worker task (0 = pool default)
+    '''
+    global _worker_pool, _worker_batch_size
+    if _worker_pool is None:
+        logger.info(f"create worker pool, cpus: {n_cpu}, batch_size: {batch_size}")
+        _worker_pool = spawn_worker_pool(n_cpu, initializer, initargs)
+        _worker_batch_size = batch_size
+    return _worker_pool
 
-        with get_context("spawn").Pool(processes=n_cpu) as pool:
-            results = pool.starmap(fn, zip(files, *additional_params))
 
-            logger.debug(f"{name}: {col_names}")
-            if flatten:
-                results = itertools.chain.from_iterable(results)
-            data = data.append(pd.DataFrame(results, columns=col_names),
-                               ignore_index=True)
+def close_worker_pool():
+    global _worker_pool
+    if _worker_pool is not None:
+        _worker_pool.close()
+        _worker_pool.join()
+        _worker_pool = None
 
-            cv2.destroyAllWindows()
 
-        #if pool:
-        #    pool.close()
-        #    pool.terminate()
+def set_stage_store(path):
+    '''
+    register the stage result store used by run_cached, None disables it
+    '''
+    global _stage_store
+    if _stage_store is not None:
+        _stage_store.close()
+    _stage_store = StageStore(path) if path else None
+    return _stage_store
+
 
-        if cache_path is not None:
-            data.to_csv(cache_path, index=False)
+def load_stage_results(name):
+    '''
+    results of the most recent run of stage name, None if there are none
+    '''
+    if _stage_store is None:
+        return None
+    params = _stage_store.latest_params(name)
+    if params is None:
+        return None
+    return _stage_store.load(name, params)
 
-    return data
+
+def store_stage_results(name, df):
+    '''
+    store a frame that is computed in the main process (e.g. the best
+    params per file) as run of stage name, so that it is loaded by
+    load_stage_results like the run_cached stages
+    '''
+    if _stage_store is None:
+        return
+    col_names = list(df.columns)
+    _stage_store.replace(name, frame_hash(df), col_names,
+                         df.values.tolist())
+
+
+def stage_results_digest():
+    '''
+    hash of the latest run of every stage, None without a stage store
+    '''
+    if _stage_store is None:
+        return None
+    return _stage_store.digest()
+
+
+def _apply_args(fn_args):
+    fn, args = fn_args
+    return fn(*args)
+
+
+def run_cached(fn, name, files, n_cpu, col_names, additional_params=[],
+               cache_path=None, flatten=False, store_every=64):
+    '''
+    run fn for each file (plus additional_params) on the worker pool
+    cache_path - enables the stage store for this stage, files that were
+    already processed with the same fn and keyword arguments are skipped
+    and new results are stored every store_every files
+    '''
+    store = _stage_store if cache_path is not None else None
+    frames = []
+    if store is not None:
+        params = params_hash(fn)
+        cached_files = store.processed_files(name, params)
+        if cached_files:
+            indices = [i for i, f in enumerate(files)
+                       if str(f) not in cached_files]
+            files = [files[i] for i in indices]
+            additional_params = [[data[i] for i in indices]
+                                 for data in additional_params]
+            frames.append(store.load(name, params, col_names))
+            logger.info('load existing data..')
+
+    logger.info(f'{name} files: {len(files)}, cpus: {n_cpu}')
+    if len(files) > 0:
+        args = zip(itertools.repeat(fn), zip(files, *additional_params))
+        if _worker_pool is not None:
+            pool = None
+            results = _worker_pool.imap(_apply_args, args,
+                                        chunksize=_worker_batch_size or 1)
+        else:
+            pool = spawn_worker_pool(n_cpu, init_worker, _worker_initargs)
+            results = pool.imap(_apply_args, args)
+
+        rows, pending = [], []
+        try:
+            for result in results:
+                result = list(result) if flatten else [result]
+                rows.extend(result)
+                pending.extend(result)
+                if store is not None and len(pending) >= store_every:
+                    store.append(name, params, col_names, pending)
+                    pending = []
+        finally:
+            if store is not None and pending:
+                store.append(name, params, col_names, pending)
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        logger.debug(f"{name}: {col_names}")
+        frames.append(pd.DataFrame(rows, columns=col_names))
+
+        cv2.destroyAllWindows()
+
+    if not frames:
+        return pd.DataFrame(columns=col_names)
+    return pd.concat(frames, ignore_index=True)
 
 
 def utilize_multiprocessing(func, zipped_args, OUT_FILE_PATH, N_CPU, concat_results=False, flatten_list=False):
@@ -276,6 +510,32 @@ def calc_line_height(df_data, ignore_conf=False, plot=False):
     return lines, line_height_px
 
 
+def estimate_line_height(img, min_height=3):
+    '''
+    OCR-free line height estimation via horizontal projection profile
+    img - grayscale PIL image or numpy array
+    return mean text row height (px) within one std and number of text rows
+    '''
+    gray = np.asarray(img, dtype=np.uint8)
+    if gray.ndim == 3:
+        gray = cv2.cvtColor(gray, cv2.COLOR_RGB2GRAY)
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+
+    # rows with ink above a fraction of the mean ink density are text rows
+    profile = ink.sum(axis=1, dtype=np.int64)
+    text_rows = np.concatenate(([0], profile > profile.mean() * 0.2, [0]))
+    edges = np.flatnonzero(np.diff(text_rows.astype(np.int8)))
+    heights = edges[1::2] - edges[::2]
+    heights = heights[heights >= min_height]
+    if len(heights) == 0:
+        return np.nan, 0
+
+    mean = np.mean(heights)
+    std = np.std(heights)
+    within = heights[(heights >= mean - std) & (heights <= mean + std)]
+    return float(np.mean(within)), len(heights)
+
+
 def word_error_rate(ground_truth, hypothesis):
     from jiwer import wer
     error = wer(ground_truth, hypothesis)
@@ -303,47 +563,3 @@ def transform_to_bitmap(file_in, file_out, dpi):
     img = Image.open(file_in)
     img = img.convert("RGB")
     img.save(file_out, dpi=(dpi, dpi))
-
-
-def compress(input_file_path, output_file_path, power=0):
-    """Function to compress PDF via Ghostscript command line interface"""
-    quality = {
-        0: '/default',
-        1: '/prepress',
-        2: '/printer',
-        3: '/ebook',
-        4: '/screen'
-    }
-    try:
-        if not os.path.isfile(input_file_path):
-            logger.info(f"Error: invalid path for input PDF file")
-            return False
-
-        if input_file_path.split('.')[-1].lower() != 'pdf':
-            logger.info(f"Error: input file is not a PDF")
-            return False
-
-        gs = get_ghostscript_path()
-        initial_size = os.path.getsize(input_file_path)
-        subprocess.call([gs, '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
-                        '-dPDFSETTINGS={}'.format(quality[power]),
-                        '-dNOPAUSE', '-dQUIET', '-dBATCH',
-                        '-sOutputFile={}'.format(output_file_path),
-                         input_file_path])
-        final_size = os.path.getsize(output_file_path)
-        ratio = 1 - (final_size / initial_size)
-        logger.info("Compression by {0:.0%}.".format(ratio))
-        logger.info("Final file size is {0:.1f}MB".format(final_size / 1000000))
-        return True
-
-    except Exception as e:
-        logger.info(f"Error compress: {e}")
-        return False
-
-
-def get_ghostscript_path():
-    gs_names = ['gs', 'gswin32', 'gswin64']
-    for name in gs_names:
-        if shutil.which(name):
-            return shutil.which(name)
-    raise FileNotFoundError(f'No GhostScript executable was found on path ({"/".join(gs_names)})')
\ No newline at end of file
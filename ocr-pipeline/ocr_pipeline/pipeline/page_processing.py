@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from functools import partial
+from loguru import logger
+import pandas as pd
+
+from ocr_pipeline.pipeline.analysis_computer_vision import (
+    hocr_extract_image, return_best_binarization_parameters,
+    filter_phantom_boxes
+)
+from ocr_pipeline.pipeline.analysis_rotation import return_best_shape
+from ocr_pipeline.pipeline.api_cv import (
+    detect_rotation_api, shape_accuracy_api, adaptive_binarization_api
+)
+from ocr_pipeline.pipeline.file_preparation import open_pil_image, \
+    render_pdf_page, pdf_text_layer_dataframe
+from ocr_pipeline.pipeline.helpers import resize_image, run_cached, \
+    cached_tess_api
+from ocr_pipeline.pipeline.spelling_correction import correct_entries
+from ocr_pipeline.pipeline.word_boxes import WordBoxes
+
+
+PAGE_COLUMNS = ['file', 'gray_status', 'rotate', 'was_rotated', 'shape',
+                'width_original', 'height_original', 'width_resized',
+                'height_resized', 'mlc', 'length', 'line_height_px', 'size',
+                'c', 'method', 'measure', 'name', 'human_readable_rotation',
+                'entries']
+
+
+def text_layer_page(file, file_original, source, page, dpi=300,
+                    correction=None):
+    '''
+    born-digital pdf page: word boxes come from the pdf text layer,
+    the page is only rendered for the uploaded images
+    return result row of PAGE_COLUMNS, None if the text layer is not
+    usable and the page has to be ocred
+    '''
+    ocr_data = pdf_text_layer_dataframe(source, page, dpi)
+    if ocr_data is None:
+        return None
+    original = render_pdf_page(source, page, dpi)
+    width, height = original.size
+    ocr_data = filter_phantom_boxes(ocr_data, height)
+    if ocr_data.empty:
+        return None
+    if correction:
+        ocr_data = correct_entries(ocr_data, **correction)
+
+    original.convert('L').save(file, dpi=(dpi, dpi))
+    original.save(file_original)
+
+    return [file, True, 0, 0, 1, width, height, width, height, 100.0,
+            len(ocr_data), ocr_data.height.median(), 0, 0, 0, 100.0, None, 0,
+            WordBoxes.from_dataframe(ocr_data)]
+
+
+def process_page(file, file_original, source=None, page=None,
+                 text_layer=False, rotate_page=False, shapes=[1],
+                 cv_dynamic_size_ranges=[0.5, 1, 1.5], cv_adaptive_cs=[15, 25],
+                 cv_adaptive_methods=[0, 1], tess_lang='eng', tess_path='',
+                 tess_config='', dpi=300, binarization_search='grid',
+                 shape_search='all', line_height_estimate=False,
+                 rotation_detection='sweep', osd_min_confidence=3.0,
+                 hocr_extractor='api', correction=None):
+    '''
+    in-memory version of grayscale > rotation > shape > binarization > hocr
+    the page is decoded once and passed between stages as PIL image,
+    only the uploaded work and original image are written back to disk
+    source, page - pdf path and page index for pages that are rendered
+    on demand instead of being read from file_original
+    text_layer - use the pdf text layer instead of ocr if it is usable
+    correction - None or kwargs of correct_entries, the page is spell
+    corrected right after extraction
+    return result row of PAGE_COLUMNS
+    '''
+    if isinstance(source, str) and text_layer:
+        row = text_layer_page(file, file_original, source, int(page), dpi,
+                              correction)
+        if row is not None:
+            return row
+
+    if isinstance(source, str):
+        original = render_pdf_page(source, int(page), dpi)
+    else:
+        original = open_pil_image(file_original)
+        original.load()
+    img = original.convert('L')
+
+    with cached_tess_api(oem=1, path=tess_path, lang=tess_lang) as api:
+        # 2 rotate
+        rotation = 0
+        if rotate_page:
+            best_rotation = detect_rotation_api(img, api, tess_path,
+                                                max_size=3500,
+                                                diff_threshold=30,
+                                                detection=rotation_detection,
+                                                osd_min_confidence=osd_min_confidence)
+            rotation = best_rotation.rotate + best_rotation.human_readable_rotation
+            if rotation:
+                logger.info(f"Rotate file {file} by {rotation}°")
+                img = img.rotate(rotation, expand=True)
+                original = original.rotate(rotation, expand=True)
+
+        # 2.1 shape
+        df_shapes = pd.DataFrame(shape_accuracy_api(img, shapes, api,
+                                                    shape_search,
+                                                    line_height_estimate),
+                                 columns=['shape', 'mlc', 'length',
+                                          'line_height_px'])
+        best_shape = return_best_shape(df_shapes, 1.2)
+        width_original, height_original = img.size
+        img = resize_image(img, best_shape['shape'])
+        original = resize_image(original, best_shape['shape'])
+        width_resized, height_resized = img.size
+
+        # 3 binarization - incl. no-bin row of the shape determination
+        df_bin = pd.DataFrame(adaptive_binarization_api(img,
+                                                        best_shape.line_height_px,
+                                                        cv_adaptive_cs,
+                                                        cv_adaptive_methods,
+                                                        cv_dynamic_size_ranges,
+                                                        api,
+                                                        binarization_search,
+                                                        line_height_estimate),
+                              columns=['size', 'c', 'method', 'mlc', 'length',
+                                       'line_height_px'])
+        df_bin = df_bin.append(best_shape[['mlc', 'length', 'line_height_px']],
+                               ignore_index=True)
+        df_bin[['size', 'c', 'method']] = df_bin[['size', 'c', 'method']].fillna(value=0)
+        _, best_bin = return_best_binarization_parameters(df_bin)
+
+    # export uploaded artifacts
+    img.save(file, dpi=(dpi, dpi))
+    original.save(file_original)
+
+    # 6 hocr
+    ocr_data = hocr_extract_image(original.convert('L'), best_bin['size'],
+                                  best_bin.c, best_bin.method, height_resized,
+                                  tess_lang, tess_config, hocr_extractor)
+    if ocr_data is not None and correction:
+        ocr_data = correct_entries(ocr_data, **correction)
+    entries = WordBoxes.from_dataframe(ocr_data) \
+        if ocr_data is not None else None
+
+    return [file, True, rotation, rotation, best_shape['shape'],
+            width_original, height_original, width_resized, height_resized,
+            best_shape.mlc, best_bin.length, best_bin.line_height_px,
+            best_bin['size'], best_bin.c, best_bin.method, best_bin.mlc, None,
+            0, entries]
+
+
+def pipeline_process_pages(data, rotate_page, shapes, cv_dynamic_size_ranges,
+                           cv_adaptive_cs, cv_adaptive_methods, N_CPU,
+                           tess_lang='eng', tess_path='', tess_config='',
+                           dpi=300, binarization_search='grid',
+                           shape_search='all', line_height_estimate=False,
+                           rotation_detection='sweep',
+                           osd_min_confidence=3.0, hocr_extractor='api',
+                           correction=None):
+    '''
+    run the in-memory page chain for each page - pages are scheduled
+    independently on the workers, so one page can be in hocr while the
+    next one is in binarization, result rows keep the page order
+    data - dataframe with file and file_original columns
+    '''
+    fn = partial(process_page,
+                 rotate_page=rotate_page,
+                 shapes=shapes,
+                 cv_dynamic_size_ranges=cv_dynamic_size_ranges,
+                 cv_adaptive_cs=cv_adaptive_cs,
+                 cv_adaptive_methods=cv_adaptive_methods,
+                 tess_lang=tess_lang,
+                 tess_path=tess_path,
+                 tess_config=tess_config,
+                 dpi=dpi,
+                 binarization_search=binarization_search,
+                 shape_search=shape_search,
+                 line_height_estimate=line_height_estimate,
+                 rotation_detection=rotation_detection,
+                 osd_min_confidence=osd_min_confidence,
+                 hocr_extractor=hocr_extractor,
+                 correction=correction)
+    files = list(data.file)
+    add_params = [list(data.file_original), list(data.source),
+                  list(data.page), list(data.text_layer)]
+
+    return run_cached(fn, "in-memory pages", files, N_CPU, PAGE_COLUMNS,
+                      additional_params=add_params)
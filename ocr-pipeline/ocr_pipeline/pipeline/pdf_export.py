@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from functools import partial
+import io
+import os
+import tempfile
+import time
+
+import fitz
+from loguru import logger
+import numpy as np
+from PIL import Image
+
+from ocr_pipeline.pipeline.helpers import run_cached
+from ocr_pipeline.pipeline.word_boxes import WordBoxes
+
+PDF_BACKENDS = ['fitz', 'reportlab']
+PDF_IMAGE_FORMATS = ['jpeg', 'jpx', 'original']
+FONT_NAME = 'F0'
+
+
+def check_pdf_backend(backend):
+    if backend not in PDF_BACKENDS:
+        raise Exception(f"Invalid pdf backend '{backend}', must be one of {PDF_BACKENDS}")
+    return backend
+
+
+def check_pdf_image_format(image_format, backend='fitz'):
+    if image_format not in PDF_IMAGE_FORMATS:
+        raise Exception(f"Invalid pdf image format '{image_format}', must be one of {PDF_IMAGE_FORMATS}")
+    if image_format == 'jpx' and backend == 'reportlab':
+        raise Exception("Invalid pdf image format 'jpx', reportlab embeds jpeg or original images only")
+    return image_format
+
+
+def encode_background(image, image_format='jpeg', quality=85):
+    '''
+    background image as the bytes embedded in the pdf
+    jpeg - baseline jpeg of the given quality
+    jpx - jpeg 2000, quality maps to a compression rate of 100 - quality
+    original - the file as it is (lossless, usually much larger)
+    '''
+    if image_format == 'original':
+        with open(str(image), 'rb') as f:
+            return f.read()
+
+    with Image.open(str(image)) as img:
+        if img.mode not in ('L', 'RGB'):
+            img = img.convert('L' if img.mode in ('1', 'I', 'I;16')
+                              else 'RGB')
+        out = io.BytesIO()
+        if image_format == 'jpx':
+            img.save(out, format='JPEG2000', quality_mode='rates',
+                     quality_layers=[max(1, 100 - quality)])
+        else:
+            img.save(out, format='JPEG', quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def log_pdf_size(path, start, source_size=None):
+    '''
+    report result pdf size and writing time, source_size - summed size of
+    the background image files
+    '''
+    size = os.path.getsize(str(path))
+    if source_size:
+        logger.info("Background images {0:.1f}MB, pdf {1:.1f}MB ({2:.0%}) "
+                    "written in {3:.1f}s".format(source_size / 1000000,
+                                                 size / 1000000,
+                                                 size / source_size,
+                                                 time.time() - start))
+    else:
+        logger.info("pdf {0:.1f}MB written in {1:.1f}s".format(
+            size / 1000000, time.time() - start))
+    return size
+
+
+def text_layer_layout(boxes, font, padding=20):
+    '''
+    font size and horizontal scale of all words at once
+    same rules as create_single_pdf: words far off the median height
+    get median + padding as font size, the scale stretches the word to its
+    box width
+    return (font sizes, horizontal scales, mask of drawable words)
+    '''
+    height = boxes.height.astype(np.float64)
+    median = np.median(height) if len(height) else 10
+    font_size = np.where((height > median + padding) |
+                         (height < median - padding),
+                         median + padding, height)
+    unit_width = np.array([font.text_length(text, fontsize=1)
+                           for text in boxes.text], dtype=np.float64)
+    font_width = unit_width * font_size
+    drawable = (font_width > 0) & (font_size > 0)
+    scale = np.divide(boxes.width, font_width,
+                      out=np.ones_like(font_width), where=drawable)
+    return font_size, scale, drawable
+
+
+def insert_pdf_page(doc, image, width, height, entries, font_file, font=None,
+                    image_format='jpeg', image_quality=85):
+    '''
+    append a page with image as background and the word boxes as
+    invisible text (render mode 3) written by one shape commit
+    the background is encoded once here (see encode_background)
+    '''
+    page = doc.new_page(width=width, height=height)
+    page.insert_image(page.rect, stream=encode_background(
+        image, image_format, image_quality))
+
+    boxes = WordBoxes.from_entries(entries)
+    if boxes is None or len(boxes) == 0:
+        return page
+
+    page.insert_font(fontname=FONT_NAME, fontfile=font_file)
+    font = font or fitz.Font(fontfile=font_file)
+    font_size, scale, drawable = text_layer_layout(boxes, font)
+
+    shape = page.new_shape()
+    for left, top, box_height, text, size, sx in zip(
+            boxes.left[drawable].tolist(), boxes.top[drawable].tolist(),
+            boxes.height[drawable].tolist(),
+            np.array(boxes.text, dtype=object)[drawable].tolist(),
+            font_size[drawable].tolist(), scale[drawable].tolist()):
+        origin = fitz.Point(left, top + box_height)
+        shape.insert_text(origin, text, fontname=FONT_NAME, fontsize=size,
+                          render_mode=3, morph=(origin, fitz.Matrix(sx, 1)))
+    shape.commit()
+    return page
+
+
+def single_pdf_page(file, file_original, width, height, entries, out_dir,
+                    font_file, image_format='jpeg', image_quality=85):
+    '''
+    worker: write one page to its own pdf in out_dir
+    '''
+    out_path = os.path.join(out_dir, f"{os.getpid()}-{os.path.basename(str(file))}.pdf")
+    with fitz.open() as doc:
+        insert_pdf_page(doc, file_original, width, height, entries, font_file,
+                        image_format=image_format, image_quality=image_quality)
+        doc.save(out_path)
+    return file, out_path
+
+
+def create_single_pdf_fitz(data, out_path, title=None, font_file='',
+                           parallel=False, n_cpu=1, image_format='jpeg',
+                           image_quality=85):
+    '''
+    pymupdf version of create_single_pdf
+    parallel - render pages on the worker pool and merge them at the end
+    backgrounds are encoded as image_format on insert and the document is
+    saved deflated with deduplicated objects, so no ghostscript pass is
+    needed afterwards
+    '''
+    if title is None:
+        title = os.path.splitext(os.path.split(str(out_path))[1])[0]
+    start = time.time()
+    source_size = sum(os.path.getsize(str(f)) for f in data.file_original)
+
+    with fitz.open() as doc:
+        if parallel and len(data) > 1:
+            with tempfile.TemporaryDirectory(prefix="pdf_pages") as out_dir:
+                fn = partial(single_pdf_page, out_dir=out_dir,
+                             font_file=font_file, image_format=image_format,
+                             image_quality=image_quality)
+                pages = run_cached(fn, "pdf pages", list(data.file), n_cpu,
+                                   ['file', 'pdf'],
+                                   additional_params=[
+                                       list(data.file_original),
+                                       list(data.width_resized),
+                                       list(data.height_resized),
+                                       list(data.entries)])
+                for page_pdf in pages.pdf:
+                    with fitz.open(page_pdf) as page_doc:
+                        doc.insert_pdf(page_doc)
+        else:
+            font = fitz.Font(fontfile=font_file)
+            for i, row in enumerate(data.itertuples()):
+                logger.info(f"Creating pdf page {i} width: {row.width_resized}, height: {row.height_resized}")
+                insert_pdf_page(doc, row.file_original, row.width_resized,
+                                row.height_resized, row.entries, font_file,
+                                font, image_format, image_quality)
+
+        doc.set_metadata({
+            'title': title,
+            'author': "BOW - Batch OCR Webservice",
+            'subject': "Created by BOW - Batch OCR Webservice",
+        })
+        # garbage=4 also merges the font copies of the merged pages
+        doc.save(str(out_path), garbage=4, deflate=True)
+    log_pdf_size(out_path, start, source_size)
+    return out_path
+
+
+def optimize_pdf(input_file_path, output_file_path):
+    '''
+    in-process replacement of the ghostscript compress pass: rewrite the
+    pdf with unused and duplicate objects (e.g. font copies) removed and
+    all streams deflated, images are kept as they were embedded
+    return False if the pdf could not be rewritten
+    '''
+    start = time.time()
+    try:
+        initial_size = os.path.getsize(str(input_file_path))
+        with fitz.open(str(input_file_path)) as doc:
+            doc.save(str(output_file_path), garbage=4, deflate=True,
+                     clean=True)
+        final_size = os.path.getsize(str(output_file_path))
+    except Exception as e:
+        logger.info(f"Error optimize pdf: {e}")
+        return False
+    logger.info("Optimized pdf {0:.1f}MB -> {1:.1f}MB ({2:.0%}) in {3:.1f}s".format(
+        initial_size / 1000000, final_size / 1000000,
+        1 - final_size / initial_size, time.time() - start))
+    return True
@@ -3,30 +3,37 @@
 
 import warnings
 import os
-import hashlib
 import tempfile
 from loguru import logger
 from pathlib import Path
 import shutil
 from typing import Sequence, Union
-import pandas as pd
 import pkg_resources
-from symspellpy import SymSpell
 
 
 
 from ocr_pipeline.pipeline.analysis_computer_vision import \
-    grayscale_valid_files, pipeline_hocr_extract, \
-    pipeline_hocr_add_spellcorrection, create_single_pdf
+    grayscale_valid_files, pipeline_hocr_extract, create_single_pdf
 from ocr_pipeline.pipeline.analysis_rotation import \
-    apply_rotation_correction, export_best_shapes, apply_resize_correction
+    export_best_shapes, apply_transform_correction
 from ocr_pipeline.pipeline.api_cv import pipeline_api_rotation_determination, \
     pipeline_api_shape_determination, pipeline_api_binarization_gridsearch, \
     export_best_binarization_params
 from ocr_pipeline.pipeline.file_preparation import create_data_work_directory,\
     paths_to_df, get_valid_files, pipeline_file_format_convert, \
-    pipeline_transform_raw, pipeline_split_pdf, merge_df
-from ocr_pipeline.pipeline.helpers import resolve_tesseract_lang, compress
+    pipeline_transform_raw, pipeline_split_pdf, pipeline_plan_pdf_pages, \
+    merge_df, configure_intermediate_codec
+from ocr_pipeline.pipeline.helpers import resolve_tesseract_lang, \
+    set_stage_store, load_stage_results, store_stage_results, \
+    stage_results_digest, set_worker_initargs
+from ocr_pipeline.pipeline.page_processing import pipeline_process_pages
+from ocr_pipeline.pipeline.pdf_export import create_single_pdf_fitz, \
+    check_pdf_backend, check_pdf_image_format, optimize_pdf
+from ocr_pipeline.pipeline.dictionary_registry import \
+    configure_dictionary_registry
+from ocr_pipeline.pipeline.spelling_correction import check_correction_profile
+from ocr_pipeline.pipeline.suggestion_cache import configure_suggestion_cache
+from ocr_pipeline.pipeline.word_boxes import page_entries_payload
 
 warnings.simplefilter("ignore", UserWarning)
 
@@ -41,6 +48,16 @@ class Pipeline:
         # create results directory
         if self.config.RESULT_DIR:
             Path(self.config.RESULT_DIR).mkdir(parents=True, exist_ok=True)
+        set_stage_store(self.config.STAGE_STORE_PATH)
+        configure_dictionary_registry(self.config.dictionary_dir,
+                                      self.config.dictionary_snapshot_dir,
+                                      self.config.dictionary_memory_budget)
+        configure_suggestion_cache(self.config.spelling_cache_dir,
+                                   self.config.spelling_cache_size,
+                                   self.config.spelling_cache_disk_size)
+        configure_intermediate_codec(self.config.intermediate_codec,
+                                     self.config.dpi)
+        set_worker_initargs(self.worker_initargs())
         # create work copy of original data
         if self.config.work_directory:
             create_data_work_directory(self.config.og_directory,
@@ -62,8 +79,25 @@ class Pipeline:
         logger.info(f"config best: {self.config.tess_config_best}")
         logger.info(f"config default: {self.config.tess_config_standard}")
         logger.info(f"N_CPU: {self.config.N_CPU}, batch_size: {self.config.batch_size}")
-
-        self.sym_spell = False
+        logger.info(f"in_memory: {self.config.in_memory}")
+
+    def worker_initargs(self):
+        '''
+        init_worker arguments from the config, every worker keeps its own
+        dictionaries, so the dictionary memory budget is split between them
+        '''
+        memory_budget = self.config.dictionary_memory_budget
+        if memory_budget:
+            memory_budget = max(1, memory_budget // max(1, self.config.N_CPU))
+        return (self.config.tess_api_cache_size,
+                (self.config.dictionary_dir,
+                 self.config.dictionary_snapshot_dir,
+                 memory_budget),
+                (self.config.spelling_cache_dir,
+                 self.config.spelling_cache_size,
+                 self.config.spelling_cache_disk_size),
+                (self.config.intermediate_codec,
+                 self.config.dpi))
 
     def transform_filetypes(self, paths: Paths = None) -> Paths:
         # determine available file types
@@ -82,12 +116,23 @@ class Pipeline:
         df_files = pipeline_transform_raw(df_files,
                                           self.config.TRANSFORM_FILE_RAW,
                                           self.config.N_CPU,
-                                          self.config.to_file_format)
-        # transform PDF
-        df_files = pipeline_split_pdf(df_files, self.config.TRANSFORM_FILE_PDF,
-                                      self.config.N_CPU,
-                                      self.config.to_file_format,
-                                      self.config.dpi)
+                                          self.config.to_file_format,
+                                          self.config.raw_png_compress_level,
+                                          self.config.raw_tiff_compress_level,
+                                          self.config.raw_jpeg_quality)
+        # transform PDF - streamed pages are rendered when they are processed
+        if self.config.in_memory and self.config.stream_pdf:
+            df_files = pipeline_plan_pdf_pages(df_files,
+                                               self.config.to_file_format,
+                                               self.config.pdf_text_layer)
+        else:
+            df_files = pipeline_split_pdf(df_files,
+                                          self.config.TRANSFORM_FILE_PDF,
+                                          self.config.N_CPU,
+                                          self.config.to_file_format,
+                                          self.config.dpi)
+            df_files = df_files.assign(source=None, page=None,
+                                       text_layer=False)
 
         
         def flatten_capital_extensions(row, to_file_format):
@@ -106,20 +151,14 @@ class Pipeline:
             return row
         df_files.file = df_files.file.apply(lambda row: flatten_capital_extensions(row, f".{self.config.to_file_format}"))
 
+        df_files["file_original"] = self.file_originals(df_files.file)
         if self.config.work_directory and self.config.work_directory_original:
-            df_files["file_original"] = df_files.file.str.replace(
-                self.config.work_directory, self.config.work_directory_original,
-                regex=False)
             # create copy of work data to preserve original data color - to NOT be modified
             create_data_work_directory(self.config.work_directory,
                                        self.config.work_directory_original,
                                        overwrite=False)
         else:
-            df_files["file_original"] = df_files.file.str.replace(
-                f".{self.config.to_file_format}", f"_og.{self.config.to_file_format}",
-                regex=False)
-
-            for _, row in df_files.iterrows():
+            for _, row in df_files[df_files.source.isnull()].iterrows():
                 try:
                     shutil.copyfile(row.file, row.file_original)
                 except shutil.SameFileError:
@@ -128,9 +167,22 @@ class Pipeline:
 
         return df_files[["file", "extension", "file_original", 'master_copy',
                          'production_master',
-                         'access_copy']].sort_values(
+                         'access_copy', 'source', 'page',
+                         'text_layer']].sort_values(
             by=["file"])
 
+    def file_originals(self, files):
+        '''
+        path of the color original of each work file
+        '''
+        if self.config.work_directory and self.config.work_directory_original:
+            return files.str.replace(self.config.work_directory,
+                                     self.config.work_directory_original,
+                                     regex=False)
+        return files.str.replace(f".{self.config.to_file_format}",
+                                 f"_og.{self.config.to_file_format}",
+                                 regex=False)
+
     def grayscale_images(self, data=None) -> Paths:
 
         if data is None:
@@ -152,7 +204,7 @@ class Pipeline:
     def correct_rotation(self, data=None, tess_lang=None):
 
         if data is None:
-            data = pd.read_csv(self.config.GRAYSCALE_RESULTS_PATH)
+            data = load_stage_results("grayscaling")
         files = data.file.to_list()
 
         # determine best rotation and filter invalid files
@@ -165,46 +217,49 @@ class Pipeline:
             diff_threshold=30,
             tess_lang=tess_lang,
             tess_path=self.config.path_tess_data_fast,
+            detection=self.config.rotation_detection,
+            osd_min_confidence=self.config.osd_min_confidence
         )
-        # apply rotation correction on best scaled images
-        df = apply_rotation_correction(
-            merge_df(data, rotation_results),
-            self.config.APPLY_ROTATION_RESULTS_PATH,
-            self.config.N_CPU
-        )
-        logger.debug(list(df.columns))
-        return merge_df(data, df)
+        # the rotation is applied in memory by the shape determination and
+        # written to the files together with the resize
+        return merge_df(data, rotation_results[['file', 'rotate']])
 
     def shape_determination(self, data=None, shapes=[0.4, 0.5, 0.8], tess_lang=None):
         # determine all shapes
         if data is None:
-            data = pd.read_csv(self.config.APPLY_ROTATION_RESULTS_PATH)
+            data = load_stage_results("rotation determination")
         if tess_lang is None:
             tess_lang, _ = resolve_tesseract_lang(self.config.tess_lang)
         files = data.file.to_list()
+        rotations = None
+        if 'rotate' in data:
+            rotations = data.rotate.fillna(0).astype(int).to_list()
         results = pipeline_api_shape_determination(
             files,
             self.config.RESIZE_SHAPES_PATH,
             shapes,
             self.config.N_CPU,
             tess_lang=tess_lang,
-            tess_config=self.config.path_tess_data_fast
+            tess_config=self.config.path_tess_data_fast,
+            search=self.config.shape_search,
+            line_height_estimate=self.config.line_height_estimate,
+            rotations=rotations
         )
         # group by file and determine best resize shape
         best_shapes = merge_df(data, export_best_shapes(results,
                                                         self.config.RESIZE_BEST_SHAPES_PATH))
         logger.debug(list(best_shapes.columns))
 
-        # apply resize to work and original data
-        return merge_df(data, apply_resize_correction(best_shapes,
-                                                      self.config.APPLY_RESIZE_RESULTS_PATH,
-                                                      self.config.N_CPU))
+        # apply rotation and resize to work and original data
+        return merge_df(data, apply_transform_correction(best_shapes,
+                                                         self.config.APPLY_RESIZE_RESULTS_PATH,
+                                                         self.config.N_CPU))
 
     def binarization(self, data=None, cv_dynamic_size_ranges=[0.5, 1, 1.5],
                      cv_adaptive_cs=[15, 25], cv_adaptive_methods=[0, 1],
                      tess_lang=None):
         if data is None:
-            data = pd.read_csv(self.config.APPLY_RESIZE_RESULTS_PATH)
+            data = load_stage_results("shape correction")
 
         results = pipeline_api_binarization_gridsearch(
             data,
@@ -214,7 +269,9 @@ class Pipeline:
             self.config.GS_MLC_RESULTS_PATH_ALL,
             self.config.N_CPU,
             tess_lang=tess_lang,
-            tess_config=self.config.path_tess_data_fast)
+            tess_config=self.config.path_tess_data_fast,
+            search=self.config.binarization_search,
+            line_height_estimate=self.config.line_height_estimate)
 
         # add no-bin row to evaluate:
         results = results.append(data[['file', 'mlc',
@@ -223,28 +280,26 @@ class Pipeline:
         results[['size', 'c', 'method']] = results[['size', 'c', 'method']].fillna(value=0)
 
         # export best results
-        return merge_df(data, export_best_binarization_params(results,
-                                                              self.config.GS_PATH))
-
+        best_params = export_best_binarization_params(results,
+                                                      self.config.GS_PATH)
+        store_stage_results("best binarization", best_params)
+        return merge_df(data, best_params)
 
-    def init_correction_lib_symspell(self, dict_symspell):
-        if self.sym_spell:
-            return True
-        logger.info('init symspell')
-        sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
-        dictionary_path = f"/app/symspell_dictionaries/{dict_symspell}"
-        sym_spell.load_dictionary(dictionary_path, term_index=0, count_index=1)
-        self.sym_spell = sym_spell
-        return self.sym_spell
 
-    def export_hocr(self, data=None, tess_lang=None, ocr_correction=None, dict_enchant="en_US"):
-        if ocr_correction is None or tess_lang is None:
-            tess_lang, ocr_correction = resolve_tesseract_lang(self.config.tess_lang)
+    def export_hocr(self, data=None, tess_lang=None, correction=None):
+        '''
+        correction - None or kwargs of correct_entries (see correction_params)
+        '''
+        if tess_lang is None:
+            tess_lang, ocr_correction, dict_symspell, dict_enchant = resolve_tesseract_lang(self.config.tess_lang)
+            if correction is None and ocr_correction:
+                correction = self.correction_params(dict_symspell, dict_enchant)
 
         if data is None:
-            df_a = pd.read_csv(self.config.GS_PATH).fillna(0)
-            df_b = pd.read_csv(self.config.ROTATION_RESULTS_PATH).fillna(0)
+            df_a = load_stage_results("best binarization").fillna(0)
+            df_b = load_stage_results("shape correction").fillna(0)
             data = merge_df(df_a, df_b)
+            data["file_original"] = self.file_originals(data.file)
 
         if self.config.HOCR_DIR:
             Path(self.config.HOCR_DIR).mkdir(parents=True, exist_ok=True)
@@ -255,66 +310,83 @@ class Pipeline:
             self.config.HOCR_RESULTS_PATH,
             self.config.N_CPU,
             tess_lang,
-            self.config.tess_config_best))
-
-        if ocr_correction:
-            logger.info('hOCR spelling correction workflow')
-            df = pipeline_hocr_add_spellcorrection(df,
-                                                   sym_spell=self.sym_spell,
-                                                   repeated_words_list=[],
-                                                   dict_enchant=dict_enchant)
-            if self.config.HOCR_RESULTS_PATH is not None:
-                df.to_csv(self.config.HOCR_RESULTS_PATH, index=False)
+            self.config.tess_config_best,
+            self.config.hocr_extractor,
+            correction))
         return df
 
-    def export_single_pdf(self, data, out_path=None):
-        from reportlab.pdfbase import pdfmetrics
-        from reportlab.pdfbase.ttfonts import TTFont
-        pdfmetrics.registerFont(TTFont('FreeSans', '/home/work/ocr/FreeSans.ttf', 'UTF-8'))
+    def correction_params(self, dict_symspell, dict_enchant, profile=None):
+        '''
+        kwargs of correct_entries - pages are spell corrected in the worker
+        that extracted them, with worker-local dictionaries
+        '''
+        if profile is None:
+            profile = self.config.correction_profile
+        return {'dict_symspell': dict_symspell,
+                'dict_enchant': dict_enchant,
+                'profile': check_correction_profile(profile),
+                'conf_threshold': self.config.correction_conf_threshold}
+
+    def process_pages(self, data, rotate_page=False, shapes=[0.4, 0.5, 0.8],
+                      cv_dynamic_size_ranges=[0.5, 1, 1.5],
+                      cv_adaptive_cs=[15, 25], cv_adaptive_methods=[0, 1],
+                      tess_lang=None, correction=None):
+        '''
+        in-memory alternative to grayscale_images > correct_rotation >
+        shape_determination > binarization > export_hocr
+        correction - None or kwargs of correct_entries
+        '''
+        if tess_lang is None:
+            tess_lang, _, _, _ = resolve_tesseract_lang(self.config.tess_lang)
+
+        df = pipeline_process_pages(data, rotate_page, shapes,
+                                    cv_dynamic_size_ranges, cv_adaptive_cs,
+                                    cv_adaptive_methods, self.config.N_CPU,
+                                    tess_lang=tess_lang,
+                                    tess_path=self.config.path_tess_data_fast,
+                                    tess_config=self.config.tess_config_best,
+                                    dpi=self.config.dpi,
+                                    binarization_search=self.config.binarization_search,
+                                    shape_search=self.config.shape_search,
+                                    line_height_estimate=self.config.line_height_estimate,
+                                    rotation_detection=self.config.rotation_detection,
+                                    osd_min_confidence=self.config.osd_min_confidence,
+                                    hocr_extractor=self.config.hocr_extractor,
+                                    correction=correction)
+        return merge_df(data, df)
 
+    def export_single_pdf(self, data, out_path=None):
         if out_path is None:
             out_path = self.config.HOCR_DIR + "/out.pdf"
+        title = os.path.splitext(os.path.split(str(out_path))[1])[0].replace("_result", "")
+
+        backend = check_pdf_backend(self.config.pdf_backend)
+        image_format = check_pdf_image_format(self.config.pdf_image_format,
+                                              backend)
+        if backend == 'fitz':
+            return create_single_pdf_fitz(data, out_path, title=title,
+                                          font_file=self.config.pdf_font,
+                                          parallel=self.config.pdf_parallel,
+                                          n_cpu=self.config.N_CPU,
+                                          image_format=image_format,
+                                          image_quality=self.config.pdf_image_quality)
 
-        with tempfile.NamedTemporaryFile(suffix='.pdf') as temp:
-            _ = create_single_pdf(data, temp.name,title=os.path.splitext(os.path.split(str(out_path))[1])[0].replace("_result",""))
-            success = compress(temp.name, out_path, power=1)
-            if not success:
-                out_path = temp.name
-
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        pdfmetrics.registerFont(TTFont('FreeSans', self.config.pdf_font, 'UTF-8'))
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp:
+            _ = create_single_pdf(data, temp.name, title=title,
+                                  image_format=image_format,
+                                  image_quality=self.config.pdf_image_quality)
+        success = optimize_pdf(temp.name, out_path)
+        if not success:
+            return temp.name
+        os.remove(temp.name)
         return out_path
 
     def convert_page(self, row, correction_included):
-        entries = pd.DataFrame.from_dict(row.entries)
-        converted_entries = [
-            {
-                "top": entry.top,
-                "conf": entry.conf,
-                "left": entry.left,
-                "text": entry.text,
-                "width": entry.width,
-                "height": entry.height,
-                "time": None,  # entry.time,
-                "correction": entry.corrections if correction_included and entry.corrections != '[UNK]' else ""
-            }
-            for _, entry in entries.iterrows()
-        ]
-
-        entities = []
-        start = 0
-        for entry in converted_entries:
-            end = start + len(entry["text"])
-            if entry["time"]:
-                entities.append({
-                    "start": start,
-                    "end": end,
-                    "score": 1.0,
-                    "type": "time",
-                    "value": entry["time"],
-                })
-
-            start = end + 1
-
-        text = " ".join(entry["text"] for entry in converted_entries)
+        converted_entries, text, entities = page_entries_payload(
+            row.entries, correction_included)
 
         if "was_rotated" not in row:
             row.was_rotated = 0
@@ -356,12 +428,17 @@ class Pipeline:
             ]
         }
 
-    def process_single(self, file: Path, lang: str = None):
+    def process_single(self, file: Path, lang: str = None,
+                       correction_profile: str = None):
         if lang is None:
             lang = self.config.tess_lang
 
         tess_lang, ocr_correction, dict_symspell, dict_enchant = resolve_tesseract_lang(lang)
         logger.info(f"Language Config: {tess_lang}, {ocr_correction}, {dict_symspell}, {dict_enchant}, {lang}")
+        correction = None
+        if ocr_correction:
+            correction = self.correction_params(dict_symspell, dict_enchant,
+                                                correction_profile)
 
         if str(file.suffix.upper()) == '.JPEG':
             base, _ = os.path.splitext(str(file))
@@ -372,17 +449,28 @@ class Pipeline:
             raise Exception(f"The file type {file.suffix} is not supported")
 
         data = self.transform_filetypes([file])
-        data = self.grayscale_images(data)
-        if str(file.suffix.upper()) in ['.ARW', '.DNG']:
-            data = self.correct_rotation(data, tess_lang=tess_lang)
-        data = self.shape_determination(data,
-                                        shapes=[0.2, 0.3, 0.4, 0.5, 0.8, 1],
-                                        tess_lang=tess_lang)
-        data = self.binarization(data,
-                                 cv_dynamic_size_ranges=[0.5, 1, 1.5],
-                                 cv_adaptive_cs=[15, 25],
-                                 cv_adaptive_methods=[0, 1],
-                                 tess_lang=tess_lang)
+        rotate_page = str(file.suffix.upper()) in ['.ARW', '.DNG']
+        if self.config.in_memory:
+            data = self.process_pages(data,
+                                      rotate_page=rotate_page,
+                                      shapes=[0.2, 0.3, 0.4, 0.5, 0.8, 1],
+                                      cv_dynamic_size_ranges=[0.5, 1, 1.5],
+                                      cv_adaptive_cs=[15, 25],
+                                      cv_adaptive_methods=[0, 1],
+                                      tess_lang=tess_lang,
+                                      correction=correction)
+        else:
+            data = self.grayscale_images(data)
+            if rotate_page:
+                data = self.correct_rotation(data, tess_lang=tess_lang)
+            data = self.shape_determination(data,
+                                            shapes=[0.2, 0.3, 0.4, 0.5, 0.8, 1],
+                                            tess_lang=tess_lang)
+            data = self.binarization(data,
+                                     cv_dynamic_size_ranges=[0.5, 1, 1.5],
+                                     cv_adaptive_cs=[15, 25],
+                                     cv_adaptive_methods=[0, 1],
+                                     tess_lang=tess_lang)
 
         data = data.astype({"size": "int",
                             "c": "int",
@@ -390,9 +478,8 @@ class Pipeline:
                             "length": "int",
                             "mlc": "float"})
 
-        self.sym_spell = False
-        self.init_correction_lib_symspell(dict_symspell)
-        data = self.export_hocr(data, tess_lang, ocr_correction, dict_enchant)
+        if not self.config.in_memory:
+            data = self.export_hocr(data, tess_lang, correction)
 
         # data = self.time_recognition(data)
         pdf_file = file.parent / f"{file.stem}_result.pdf"
@@ -402,15 +489,13 @@ class Pipeline:
         return self.convert_processing_output(data, pdf_file, ocr_correction, tess_lang[:3])
 
     def hash_output(self):
-        BLOCK_SIZE = 65536
-        file_hash = hashlib.sha256()
-        results_path = Path(self.config.RESULT_DIR)
-
-        for path in sorted(results_path.glob("*.csv")):
-            with path.open("rb") as f:
-                fb = f.read(BLOCK_SIZE)
-                while len(fb) > 0:
-                    file_hash.update(fb)
-                    fb = f.read(BLOCK_SIZE)
-        with (results_path / "output_hash.txt").open("w", encoding="utf8") as f:
-            f.write(file_hash.hexdigest())
+        '''
+        write the hash of the latest stage results to output_hash.txt
+        '''
+        digest = stage_results_digest()
+        if digest is None:
+            return None
+        with (Path(self.config.RESULT_DIR) / "output_hash.txt").open(
+                "w", encoding="utf8") as f:
+            f.write(digest)
+        return digest
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import hashlib
+import json
+import os
+
 from everett.component import RequiredConfigMixin, ConfigOptions
 from everett.manager import ConfigManager
 
@@ -18,14 +22,24 @@ class PipelineConfig(RequiredConfigMixin):
     required_config.add_option(
         'N_CPU',
         parser=int,
-        default="1",
-        doc=''
+        default="0",
+        doc='number of worker processes, 0 uses all cores'
     )
     required_config.add_option(
         'batch_size',
         parser=int,
         default='0',
-        doc=''
+        doc='number of pages sent to a worker per task, 0 lets the pool decide'
+    )
+
+    # in-memory page handoff between stages
+    required_config.add_option(
+        'in_memory',
+        parser=bool,
+        default='True',
+        doc='schedule each page independently through all stages and pass '
+            'it between stages as image, only uploaded artifacts are '
+            'written to disk - False runs stage by stage over all pages'
     )
 
     # tesseract
@@ -49,6 +63,78 @@ class PipelineConfig(RequiredConfigMixin):
         default='/usr/local/share/tessdata'
     )
 
+    required_config.add_option(
+        'tess_api_cache_size',
+        parser=int,
+        default='4',
+        doc='initialized idle tesseract apis kept per worker (lru by '
+            'language), apis in use are never ended; keep at least 2 so the '
+            'osd api is reused next to the page api'
+    )
+
+    # spelling correction
+    required_config.add_option(
+        'dictionary_dir',
+        parser=str,
+        default='/app/symspell_dictionaries',
+        doc='symspell word lists'
+    )
+
+    required_config.add_option(
+        'dictionary_snapshot_dir',
+        parser=str,
+        default='',
+        doc='prebuilt symspell index snapshots, empty uses the temp dir'
+    )
+
+    required_config.add_option(
+        'dictionary_memory_budget',
+        parser=int,
+        default='2048',
+        doc='MB of loaded symspell indices across the worker pool (lru by '
+            'language), split evenly between the N_CPU workers, each keeps '
+            'at least its last used dictionary, 0 keeps all'
+    )
+
+    required_config.add_option(
+        'correction_profile',
+        parser=str,
+        default='full',
+        doc="default spelling correction profile: 'full' (nltk names, enchant "
+            "and symspell) or 'fast' (symspell only, capitalization "
+            "heuristic for names), can be overridden per message"
+    )
+
+    required_config.add_option(
+        'correction_conf_threshold',
+        parser=int,
+        default='90',
+        doc='only words below this tesseract confidence or missing in the '
+            'dictionary are spell corrected, negative corrects all words'
+    )
+
+    required_config.add_option(
+        'spelling_cache_dir',
+        parser=str,
+        default='',
+        doc='directory of the persistent spelling suggestion caches '
+            '(one sqlite file per dictionary), empty keeps them in memory only'
+    )
+
+    required_config.add_option(
+        'spelling_cache_size',
+        parser=int,
+        default='100000',
+        doc='words kept in memory per dictionary (lru)'
+    )
+
+    required_config.add_option(
+        'spelling_cache_disk_size',
+        parser=int,
+        default='1000000',
+        doc='words kept on disk per dictionary, oldest are dropped first'
+    )
+
     # config & language
     required_config.add_option(
         'tess_config',
@@ -71,6 +157,57 @@ class PipelineConfig(RequiredConfigMixin):
         doc=''
     )
 
+    # 2 rotate
+    required_config.add_option(
+        'rotation_detection',
+        parser=str,
+        default='sweep',
+        doc='rotation detection: sweep (2/4 orientation ocr passes) or '
+            'osd (single osd pass, sweep as low confidence fallback)'
+    )
+    required_config.add_option(
+        'osd_min_confidence',
+        parser=float,
+        default='3.0',
+        doc='min osd orientation confidence to skip the rotation sweep'
+    )
+
+    # 2.1 resize / 3 binarization
+    required_config.add_option(
+        'line_height_estimate',
+        parser=bool,
+        default='False',
+        doc='use OCR-free projection profile line height to skip shapes '
+            'and seed binarization sizes'
+    )
+
+    # 2.1 resize
+    required_config.add_option(
+        'shape_search',
+        parser=str,
+        default='all',
+        doc='resize shape search: all (every shape) or bisect (skip and '
+            'bisect shapes by line height)'
+    )
+
+    # 3 binarization
+    required_config.add_option(
+        'binarization_search',
+        parser=str,
+        default='grid',
+        doc='binarization candidate search: grid (all combinations) or '
+            'halving (successive halving on cropped proxies)'
+    )
+
+    # 6 hocr
+    required_config.add_option(
+        'hocr_extractor',
+        parser=str,
+        default='api',
+        doc='final word box extraction: api (in-process tesserocr with '
+            'cached best model) or pytesseract (tesseract subprocess)'
+    )
+
     # 0.1 result director
     required_config.add_option(
         'RESULT_DIR',
@@ -124,12 +261,78 @@ class PipelineConfig(RequiredConfigMixin):
         default='png',
         doc='either png or jpg for base file format across the pipeline'
     )
+    required_config.add_option(
+        'intermediate_codec',
+        parser=str,
+        default='png',
+        doc="codec of work files rewritten between stages: 'png', 'png1' "
+            "(compress_level 1), 'tiff' (uncompressed) or 'npy' (numpy "
+            "array), uploaded images keep the format of their extension"
+    )
+    required_config.add_option(
+        'raw_png_compress_level',
+        parser=int,
+        default='1',
+        doc='zlib level (0-9) of the png working image of raw files'
+    )
+    required_config.add_option(
+        'raw_tiff_compress_level',
+        parser=int,
+        default='0',
+        doc='zlib level (0-9) of the 16 bit raw master copy tiff, '
+            '0 = uncompressed'
+    )
+    required_config.add_option(
+        'raw_jpeg_quality',
+        parser=int,
+        default='75',
+        doc='quality (1-100) of the raw access copy jpg'
+    )
     required_config.add_option(
         'dpi',
         parser=int,
         default='300',
         doc='dots per inch conversion value'
     )
+
+    # 8 pdf export
+    required_config.add_option(
+        'pdf_backend',
+        parser=str,
+        default='fitz',
+        doc="result pdf writer: 'fitz' (pymupdf, bulk text layer) or "
+            "'reportlab'"
+    )
+
+    required_config.add_option(
+        'pdf_parallel',
+        parser=bool,
+        default='False',
+        doc='fitz only: render result pdf pages on the worker pool and '
+            'merge them'
+    )
+
+    required_config.add_option(
+        'pdf_font',
+        parser=str,
+        default='/home/work/ocr/FreeSans.ttf',
+        doc='font of the invisible pdf text layer'
+    )
+
+    required_config.add_option(
+        'pdf_image_format',
+        parser=str,
+        default='jpeg',
+        doc="encoding of the result pdf backgrounds: 'jpeg', 'jpx' "
+            "(fitz only) or 'original' (the image files as they are)"
+    )
+
+    required_config.add_option(
+        'pdf_image_quality',
+        parser=int,
+        default='85',
+        doc='quality (1-100) of the jpeg/jpx result pdf backgrounds'
+    )
     required_config.add_option(
         'TRANSFORM_FILE_PNG',
         parser=str,
@@ -149,6 +352,31 @@ class PipelineConfig(RequiredConfigMixin):
         doc='store success of transformation'
     )
 
+    required_config.add_option(
+        'stream_pdf',
+        parser=bool,
+        default='True',
+        doc='in-memory mode only: render pdf pages on demand in the workers '
+            'instead of splitting the whole pdf to images upfront'
+    )
+
+    required_config.add_option(
+        'pdf_text_layer',
+        parser=bool,
+        default='False',
+        doc='stream_pdf only: take word boxes of pages with a usable text '
+            'layer directly from the pdf instead of ocr, scans with an '
+            'invisible ocr layer are still ocred'
+    )
+
+    required_config.add_option(
+        'STAGE_STORE_PATH',
+        parser=str,
+        default='stage_results.sqlite',
+        doc='sqlite store of all cached stage results (replaces the per-stage '
+            'csv caches)'
+    )
+
     # 1 gray
     required_config.add_option(
         'GRAYSCALE_RESULTS_PATH',
@@ -176,12 +404,6 @@ class PipelineConfig(RequiredConfigMixin):
         default='2_1_1_rotate_results_invalid.csv',
         doc='stores invalid files that yielded a NaN result'
     )
-    required_config.add_option(
-        'APPLY_ROTATION_RESULTS_PATH',
-        parser=str,
-        default='2_2_rotate_apply_correction.csv',
-        doc='avoid applying rotation twice if file exists'
-    )
 
     # 2.1 Resize
     required_config.add_option(
@@ -294,14 +516,27 @@ class PipelineConfig(RequiredConfigMixin):
         self.DEV = self.config('DEV')
 
         # CPU
-        self.N_CPU = self.config('N_CPU')
+        self.N_CPU = self.config('N_CPU') or os.cpu_count()
         self.batch_size = self.config('batch_size')
+        self.in_memory = self.config('in_memory')
 
         # TESSERACT
         # tess paths
         self.path_tess_data_fast = self.config('path_tess_data_fast')
         self.path_tess_data_best = self.config('path_tess_data_best')
         self.path_tess_data_standard = self.config('path_tess_data_standard')
+        self.tess_api_cache_size = self.config('tess_api_cache_size')
+        # spelling correction
+        self.dictionary_dir = self.config('dictionary_dir')
+        self.dictionary_snapshot_dir = self.config('dictionary_snapshot_dir')
+        self.dictionary_memory_budget = self.config('dictionary_memory_budget')
+        self.correction_profile = self.config('correction_profile')
+        self.correction_conf_threshold = self.config('correction_conf_threshold')
+        if self.correction_conf_threshold < 0:
+            self.correction_conf_threshold = None
+        self.spelling_cache_dir = self.config('spelling_cache_dir')
+        self.spelling_cache_size = self.config('spelling_cache_size')
+        self.spelling_cache_disk_size = self.config('spelling_cache_disk_size')
         # tess configs
         self.tess_config_fast = self.config(
             'tess_config') + " --tessdata-dir " + self.config(
@@ -331,10 +566,27 @@ class PipelineConfig(RequiredConfigMixin):
 
         # 0.1 evaluation
         self.measure_method = self.config('measure_method')
+        self.rotation_detection = self.config('rotation_detection')
+        self.osd_min_confidence = self.config('osd_min_confidence')
+        self.line_height_estimate = self.config('line_height_estimate')
+        self.shape_search = self.config('shape_search')
+        self.binarization_search = self.config('binarization_search')
+        self.hocr_extractor = self.config('hocr_extractor')
 
         # 0 file format
         self.to_file_format = self.config('to_file_format')
+        self.intermediate_codec = self.config('intermediate_codec')
+        self.raw_png_compress_level = self.config('raw_png_compress_level')
+        self.raw_tiff_compress_level = self.config('raw_tiff_compress_level')
+        self.raw_jpeg_quality = self.config('raw_jpeg_quality')
         self.dpi = self.config('dpi')
+        self.pdf_backend = self.config('pdf_backend')
+        self.pdf_parallel = self.config('pdf_parallel')
+        self.pdf_font = self.config('pdf_font')
+        self.pdf_image_format = self.config('pdf_image_format')
+        self.pdf_image_quality = self.config('pdf_image_quality')
+        self.stream_pdf = self.config('stream_pdf')
+        self.pdf_text_layer = self.config('pdf_text_layer')
 
         if not self.RESULT_DIR:
             self.RESULT_DIR = None
@@ -343,11 +595,11 @@ class PipelineConfig(RequiredConfigMixin):
             self.TRANSFORM_FILE_PNG = None
             self.TRANSFORM_FILE_RAW = None
             self.TRANSFORM_FILE_PDF = None
+            self.STAGE_STORE_PATH = None
             self.GRAYSCALE_RESULTS_PATH = None
             self.ROTATION_RESULTS_PATH_ALL = None
             self.ROTATION_RESULTS_PATH = None
             self.ROTATION_RESULTS_INVALID_PATH = None
-            self.APPLY_ROTATION_RESULTS_PATH = None
             self.RESIZE_SHAPES_PATH = None
             self.RESIZE_BEST_SHAPES_PATH = None
             self.APPLY_RESIZE_RESULTS_PATH = None
@@ -377,6 +629,9 @@ class PipelineConfig(RequiredConfigMixin):
             self.TRANSFORM_FILE_PDF = self.config('RESULT_DIR') + self.config(
                 'TRANSFORM_FILE_PDF')
 
+            self.STAGE_STORE_PATH = self.config('RESULT_DIR') + self.config(
+                'STAGE_STORE_PATH')
+
             # 1 grayscale
             self.GRAYSCALE_RESULTS_PATH = self.config('RESULT_DIR') + self.config(
                 'GRAYSCALE_RESULTS_PATH')
@@ -388,8 +643,6 @@ class PipelineConfig(RequiredConfigMixin):
                 'ROTATION_RESULTS_PATH')
             self.ROTATION_RESULTS_INVALID_PATH = self.config(
                 'RESULT_DIR') + self.config('ROTATION_RESULTS_INVALID_PATH')
-            self.APPLY_ROTATION_RESULTS_PATH = self.config(
-                'RESULT_DIR') + self.config('APPLY_ROTATION_RESULTS_PATH')
             # 2.1 Resize
             self.RESIZE_SHAPES_PATH = self.config('RESULT_DIR') + self.config(
                 'RESIZE_SHAPES_PATH')
@@ -439,6 +692,25 @@ class PipelineConfig(RequiredConfigMixin):
             self.GS_PATH = self.GS_MLC_RESULTS_PATH
 
 
+    def version(self):
+        '''
+        hash of all options that can change the output
+        resource options (cpu, batching, caches) are left out
+        '''
+        ignored = {'config', 'N_CPU', 'batch_size', 'tess_api_cache_size',
+                   'dictionary_snapshot_dir', 'dictionary_memory_budget',
+                   'pdf_parallel', 'intermediate_codec',
+                   'raw_png_compress_level',
+                   'raw_tiff_compress_level',
+                   'spelling_cache_dir', 'spelling_cache_size',
+                   'spelling_cache_disk_size'}
+        options = {key: value for key, value in vars(self).items()
+                   if key not in ignored and
+                   isinstance(value, (str, int, float, bool, list, type(None)))}
+        return hashlib.sha256(
+            json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+
+
 def init_config(path_to_config):
     config_dict = open(path_to_config, 'r').read()
     config_dict = eval(config_dict)
@@ -7,10 +7,12 @@ import pandas as pd
 import nltk
 import re
 from tqdm import tqdm
-from enchant.checker import SpellChecker
 from difflib import SequenceMatcher
 import jellyfish
 
+from ocr_pipeline.pipeline.dictionary_registry import get_dictionary_registry
+from ocr_pipeline.pipeline.suggestion_cache import get_suggestion_cache
+
 
 def get_spelling_correction(word, n_best, sym_spell):
     try:
@@ -86,23 +88,86 @@ def build_repeated_words_list(EXPORT_RESULTS_PATH, occur_threshold=3):
     return repeated_words_list
 
 
-def error_detection(text, repeated_words_list, sym_spell, dict_enchant="en_US"):
+CORRECTION_PROFILES = ['fast', 'full']
+
+
+def check_correction_profile(profile):
+    if profile not in CORRECTION_PROFILES:
+        raise Exception(f"Invalid correction profile '{profile}', must be one of {CORRECTION_PROFILES}")
+    return profile
+
+
+def get_capitalized_words(words, words_clean):
+    '''
+    cheap stand-in for nltk ne chunking (fast profile)
+    words - original tokens, words_clean - their cleaned version
+    return cleaned words of capitalized tokens that do not start a sentence
+    '''
+    capitalized = []
+    sentence_start = True
+    for word, word_clean in zip(words, words_clean):
+        word = word if isinstance(word, str) else ''
+        if word[:1].isupper() and not sentence_start:
+            capitalized.append(word_clean)
+        sentence_start = word.endswith(('.', '!', '?', ':'))
+    return capitalized
+
+
+def lookup_suggestions(word, d, sym_spell, suggestion_cache=None,
+                       profile='full'):
+    '''
+    return (enchant suggestions, symspell suggestions, symspell segmentation)
+    of word, memoized by suggestion_cache
+    profile 'fast' - symspell lookup only
+    '''
+    if suggestion_cache is not None:
+        cached = suggestion_cache.get(word)
+        if cached is not None:
+            return cached
+    if profile == 'fast':
+        suggestions = ([], get_spelling_correction(word, 200, sym_spell), [])
+    else:
+        suggestions = (d.suggest(word),
+                       get_spelling_correction(word, 200, sym_spell),
+                       get_word_segmentation(word, sym_spell))
+    if suggestion_cache is not None:
+        suggestion_cache.put(word, suggestions)
+    return suggestions
+
+
+def error_detection(text, repeated_words_list, sym_spell, dict_enchant="en_US",
+                    suggestion_cache=None, profile='full', names=None):
+    '''
+    profile 'full' - nltk person names, enchant detection and suggestions
+    profile 'fast' - names (capitalization heuristic), symspell detection
+    and suggestions
+    '''
     # building list of ignore words
-    persons_list = get_personslist(text)
+    if profile == 'fast':
+        persons_list = list(names or [])
+    else:
+        persons_list = get_personslist(text)
     punctuation = list(r"!,.?!({[]})_-–+*/\%$¥€'")
-    ignorewords = persons_list + list(punctuation) + repeated_words_list
+    ignorewords = set(persons_list + list(punctuation) + repeated_words_list)
 
-    # using enchant.checker.SpellChecker -> detect incorrect words
-    d = SpellChecker(dict_enchant)
     words = text.split()
 
     # check each word
-    incorrectwords = [w for w in words if not d.check(w) and w not in ignorewords]
-
-    # using enchant.checker.SpellChecker -> get suggestions
-    enchant_suggestedwords = [d.suggest(w) for w in incorrectwords]
-    symspell_segmentation = [get_word_segmentation(w, sym_spell) for w in incorrectwords]
-    symspell_suggestedwords = [get_spelling_correction(w, 200, sym_spell) for w in incorrectwords]
+    if profile == 'fast':
+        d = None
+        dictionary = sym_spell.words
+        incorrectwords = [w for w in words if w not in dictionary and w not in ignorewords]
+    else:
+        # using enchant.checker.SpellChecker -> detect incorrect words
+        d = get_dictionary_registry().enchant(dict_enchant)
+        incorrectwords = [w for w in words if not d.check(w) and w not in ignorewords]
+
+    # using enchant.checker.SpellChecker & symspell -> get suggestions
+    suggestions = [lookup_suggestions(w, d, sym_spell, suggestion_cache, profile)
+                   for w in incorrectwords]
+    enchant_suggestedwords = [list(s[0]) for s in suggestions]
+    symspell_suggestedwords = [s[1] for s in suggestions]
+    symspell_segmentation = [s[2] for s in suggestions]
 
     # replace incorrect with [MASK] -> only whole word not substring of word
     text = text.split()  # word_tokenize(text)
@@ -140,7 +205,8 @@ def predict_words(text, maskids, all_suggestions, symspell_segmentation, incorre
     return text
 
 
-def apply_correction_workflow(txt, repeated_words_list, tokenizer, sym_spell, dict_enchant):
+def apply_correction_workflow(txt, repeated_words_list, tokenizer, sym_spell, dict_enchant,
+                              suggestion_cache=None, profile='full', names=None):
     '''
     detect and mask errors
     symspell & enchant correction suggestions
@@ -149,7 +215,7 @@ def apply_correction_workflow(txt, repeated_words_list, tokenizer, sym_spell, di
     all_suggestions = []
 
     # error detection and suggestions
-    txt_masked, enchant_suggestedwords, symspell_suggestedwords, symspell_segmentation, incorrectwords = error_detection(txt, repeated_words_list, sym_spell, dict_enchant)
+    txt_masked, enchant_suggestedwords, symspell_suggestedwords, symspell_segmentation, incorrectwords = error_detection(txt, repeated_words_list, sym_spell, dict_enchant, suggestion_cache, profile, names)
 
     # suggestion ranking
     for i in range(len(enchant_suggestedwords)):
@@ -218,23 +284,76 @@ def data_clean_for_spelling_correction(df, replace_empty):
 
 def add_spelling_correction_to_dataframe(df_data, sym_spell,
                                          repeated_words_list=[],
-                                         dict_enchant="en_US"):
+                                         dict_enchant="en_US",
+                                         suggestion_cache=None,
+                                         profile='full',
+                                         conf_threshold=None):
+    '''
+    profile - 'full' (nltk, enchant & symspell) or 'fast' (symspell only)
+    conf_threshold - only words below this tesseract conf or missing in the
+    symspell dictionary are corrected, None corrects all words
+    '''
+    check_correction_profile(profile)
     # text preprocessing
     replace_empty = '[UNK]'
     repeated_words_list.append(replace_empty)
     df_data = data_clean_for_spelling_correction(df_data, replace_empty)
+    df_data['corrections'] = ''
+
+    # confidence gate
+    df_gated = df_data
+    if conf_threshold is not None and 'conf' in df_data:
+        dictionary = sym_spell.words
+        conf = pd.to_numeric(df_data['conf'], errors='coerce').fillna(-1)
+        in_dictionary = df_data['text_clean'].map(lambda w: w in dictionary)
+        df_gated = df_data[(conf < conf_threshold) | ~in_dictionary]
+        logger.debug(f"spelling correction gate: {len(df_gated)}/{len(df_data)} words")
 
     n = 300
     from nltk.tokenize import WhitespaceTokenizer
     tokenizer = WhitespaceTokenizer()
     
     # process each dataframe chunk of size n
-    for g, df in df_data.groupby(np.arange(len(df_data)) // n):
+    for g, df in df_gated.groupby(np.arange(len(df_gated)) // n):
         txt = ' '.join(df['text_clean'])
-        text_corrected = apply_correction_workflow(txt, repeated_words_list, tokenizer, sym_spell, dict_enchant)
+        names = None
+        if profile == 'fast':
+            names = get_capitalized_words(df['text'], df['text_clean'])
+        text_corrected = apply_correction_workflow(txt, repeated_words_list, tokenizer, sym_spell, dict_enchant,
+                                                   suggestion_cache, profile, names)
         df_data.loc[df.index, 'corrections'] = text_corrected.split()
 
     df_data.loc[df_data['corrections'] == df_data['text_clean'], 'corrections'] = ''
     df_data.loc[df_data['corrections'].str.contains("[MASK_SAME]"), 'corrections'] = ''
     return df_data
 
+
+def suggestion_cache_name(dict_symspell, dict_enchant, profile='full'):
+    name = f"{dict_symspell}-{dict_enchant}"
+    if profile != 'full':
+        name = f"{name}-{profile}"
+    return name
+
+
+def correct_entries(ocr_data, dict_symspell, dict_enchant="en_US",
+                    profile='full', conf_threshold=None):
+    '''
+    spelling correction of a single page in the worker that extracted it
+    dictionaries and suggestion cache come from the process-wide registries
+    ocr_data - word boxes dataframe, returned with corrections column
+    '''
+    try:
+        sym_spell = get_dictionary_registry().symspell(dict_symspell)
+        suggestion_cache = get_suggestion_cache(
+            suggestion_cache_name(dict_symspell, dict_enchant, profile))
+        ocr_data = add_spelling_correction_to_dataframe(ocr_data, sym_spell,
+                                                        [], dict_enchant,
+                                                        suggestion_cache,
+                                                        profile,
+                                                        conf_threshold)
+    except Exception as e:
+        logger.info(f"no spelling correction possible: {e}")
+        ocr_data['corrections'] = ''
+        return ocr_data
+    suggestion_cache.maybe_flush()
+    return ocr_data
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if hasattr(value, 'to_dict'):
+        # WordBoxes and dataframes
+        return value.to_dict()
+    return str(value)
+
+
+def params_hash(fn):
+    '''
+    hash of the function name and its partial keyword arguments
+    '''
+    keywords = getattr(fn, 'keywords', {}) or {}
+    func = getattr(fn, 'func', fn)
+    payload = json.dumps([func.__name__, sorted(keywords.items())],
+                         default=_json_default)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def frame_hash(df):
+    '''
+    hash of the rows of a result frame that is stored as a whole
+    '''
+    payload = json.dumps(df.to_dict('records'), default=_json_default)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+class StageStore:
+    '''
+    sqlite store of stage results keyed by (stage, params, file)
+    rows are stored as json objects, so types survive the round trip and
+    results can be appended while a stage is running
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS stage_results ('
+            'stage TEXT NOT NULL, params TEXT NOT NULL, file TEXT NOT NULL, '
+            'row TEXT NOT NULL)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS stage_results_key '
+            'ON stage_results (stage, params, file)')
+        self.connection.commit()
+
+    def processed_files(self, stage, params):
+        cursor = self.connection.execute(
+            'SELECT DISTINCT file FROM stage_results '
+            'WHERE stage = ? AND params = ?', (stage, params))
+        return {file for file, in cursor}
+
+    def append(self, stage, params, col_names, rows):
+        '''
+        rows - result rows (lists in col_names order), the file is taken
+        from the 'file' column
+        '''
+        file_index = col_names.index('file')
+        self.connection.executemany(
+            'INSERT INTO stage_results (stage, params, file, row) '
+            'VALUES (?, ?, ?, ?)',
+            [(stage, params, str(row[file_index]),
+              json.dumps(dict(zip(col_names, row)), default=_json_default))
+             for row in rows])
+        self.connection.commit()
+
+    def replace(self, stage, params, col_names, rows):
+        '''
+        store rows as the run (stage, params), earlier rows of it are dropped
+        '''
+        self.connection.execute(
+            'DELETE FROM stage_results WHERE stage = ? AND params = ?',
+            (stage, params))
+        self.append(stage, params, col_names, rows)
+
+    def load(self, stage, params, col_names=None):
+        cursor = self.connection.execute(
+            'SELECT row FROM stage_results WHERE stage = ? AND params = ? '
+            'ORDER BY rowid', (stage, params))
+        return pd.DataFrame([json.loads(row) for row, in cursor],
+                            columns=col_names)
+
+    def latest_params(self, stage):
+        '''
+        params of the most recent run of stage or None
+        '''
+        row = self.connection.execute(
+            'SELECT params FROM stage_results WHERE stage = ? '
+            'ORDER BY rowid DESC LIMIT 1', (stage,)).fetchone()
+        return row[0] if row else None
+
+    def digest(self):
+        '''
+        sha256 of the rows of the most recent run of each stage
+        '''
+        digest = hashlib.sha256()
+        stages = [stage for stage, in self.connection.execute(
+            'SELECT DISTINCT stage FROM stage_results ORDER BY stage')]
+        for stage in stages:
+            cursor = self.connection.execute(
+                'SELECT file, row FROM stage_results WHERE stage = ? '
+                'AND params = ? ORDER BY file, rowid',
+                (stage, self.latest_params(stage)))
+            digest.update(stage.encode())
+            for file, row in cursor:
+                digest.update(file.encode())
+                digest.update(row.encode())
+        return digest.hexdigest()
+
+    def close(self):
+        self.connection.close()
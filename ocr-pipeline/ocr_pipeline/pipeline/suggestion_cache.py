@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from collections import OrderedDict
+import json
+from multiprocessing import util
+import os
+import re
+import sqlite3
+import time
+
+from loguru import logger
+
+
+class SuggestionCache:
+    '''
+    bounded lru memo of word -> (enchant suggestions, symspell suggestions,
+    symspell segmentation) for one dictionary
+    with a path the entries are persisted to sqlite and survive restarts,
+    the oldest entries are dropped once disk_size is exceeded
+    the sqlite file is shared by all workers, so new entries are written in
+    batches (see maybe_flush) and at process exit
+    '''
+
+    def __init__(self, path=None, size=100000, disk_size=1000000,
+                 flush_size=1000, flush_interval=60):
+        self.size = size
+        self.disk_size = disk_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.memory = OrderedDict()
+        self.pending = {}
+        self.last_flush = time.time()
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False,
+                                              timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS suggestions ('
+                'word TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                'created REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS suggestions_created '
+                'ON suggestions (created)')
+            self.connection.commit()
+
+    def get(self, word):
+        if word in self.memory:
+            self.memory.move_to_end(word)
+            return self.memory[word]
+        if self.connection is None:
+            return None
+        row = self.connection.execute(
+            'SELECT value FROM suggestions WHERE word = ?', (word,)).fetchone()
+        if row is None:
+            return None
+        value = tuple(json.loads(row[0]))
+        self._remember(word, value)
+        return value
+
+    def put(self, word, value):
+        self._remember(word, value)
+        if self.connection is not None:
+            self.pending[word] = value
+
+    def _remember(self, word, value):
+        self.memory[word] = value
+        self.memory.move_to_end(word)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def maybe_flush(self):
+        '''
+        flush once flush_size entries are pending or flush_interval seconds
+        passed since the last flush, errors are logged and the entries kept
+        pending for the next attempt
+        '''
+        if len(self.pending) < self.flush_size and \
+                time.time() - self.last_flush < self.flush_interval:
+            return
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            logger.info(f"spelling suggestion cache not flushed: {e}")
+
+    def flush(self):
+        '''
+        write pending entries to disk and enforce disk_size
+        '''
+        self.last_flush = time.time()
+        if self.connection is None or not self.pending:
+            return
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO suggestions (word, value, created) '
+            'VALUES (?, ?, ?)',
+            [(word, json.dumps(value), now)
+             for word, value in self.pending.items()])
+        count, = self.connection.execute(
+            'SELECT COUNT(*) FROM suggestions').fetchone()
+        if count > self.disk_size:
+            self.connection.execute(
+                'DELETE FROM suggestions WHERE word IN ('
+                'SELECT word FROM suggestions ORDER BY created LIMIT ?)',
+                (count - self.disk_size,))
+        self.connection.commit()
+        self.pending = {}
+
+
+_suggestion_caches = {}
+_suggestion_cache_dir = None
+_suggestion_cache_size = 100000
+_suggestion_cache_disk_size = 1000000
+
+
+def configure_suggestion_cache(cache_dir=None, size=100000,
+                               disk_size=1000000):
+    '''
+    cache_dir - directory of the per dictionary sqlite files,
+    None keeps the suggestions in memory only
+    '''
+    global _suggestion_cache_dir, _suggestion_cache_size, \
+        _suggestion_cache_disk_size
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    _suggestion_cache_dir = cache_dir or None
+    _suggestion_cache_size = size
+    _suggestion_cache_disk_size = disk_size
+
+
+def flush_suggestion_caches():
+    for cache in _suggestion_caches.values():
+        try:
+            cache.flush()
+        except sqlite3.Error as e:
+            logger.info(f"spelling suggestion cache not flushed: {e}")
+
+
+# pool workers leave through multiprocessing, which skips atexit handlers
+util.Finalize(None, flush_suggestion_caches, exitpriority=10)
+
+
+def get_suggestion_cache(dictionary):
+    '''
+    process-wide suggestion cache of a dictionary (e.g. symspell + enchant
+    dictionary name), shared by all pages and messages
+    '''
+    if dictionary not in _suggestion_caches:
+        path = None
+        if _suggestion_cache_dir is not None:
+            name = re.sub(r'[^\w.-]', '_', dictionary)
+            path = os.path.join(_suggestion_cache_dir, f"{name}.sqlite")
+            logger.info(f"spelling suggestion cache: {path}")
+        _suggestion_caches[dictionary] = SuggestionCache(
+            path, _suggestion_cache_size, _suggestion_cache_disk_size)
+    return _suggestion_caches[dictionary]
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+import pandas as pd
+
+
+def _pack_strings(strings):
+    '''
+    string table: all strings joined plus their end offsets
+    '''
+    strings = ['' if not isinstance(s, str) else s for s in strings]
+    offsets = np.cumsum([len(s) for s in strings], dtype=np.int64)
+    return ''.join(strings), offsets
+
+
+def _unpack_strings(joined, offsets):
+    starts = np.concatenate(([0], offsets[:-1])) if len(offsets) else offsets
+    return [joined[start:end] for start, end in zip(starts.tolist(),
+                                                    offsets.tolist())]
+
+
+class WordBoxes:
+    '''
+    compact columnar word boxes of a page (level 5 image_to_data rows)
+    box coordinates and conf are numpy arrays, text and corrections are
+    string tables, so a page pickles as a handful of buffers instead of a
+    dict of dicts - convert to dataframe or json only where needed
+    conf keeps integer confidences (tesseract 4 tsv) as int, missing
+    corrections stay NaN like in the dataframe
+    '''
+    COORDINATES = ['left', 'top', 'width', 'height']
+    __slots__ = ['left', 'top', 'width', 'height', 'conf',
+                 '_text', '_text_offsets', '_corrections',
+                 '_corrections_offsets', '_corrections_missing']
+
+    def __init__(self, left, top, width, height, conf, text,
+                 corrections=None):
+        self.left = np.asarray(left, dtype=np.int32)
+        self.top = np.asarray(top, dtype=np.int32)
+        self.width = np.asarray(width, dtype=np.int32)
+        self.height = np.asarray(height, dtype=np.int32)
+        conf = np.asarray(conf)
+        self.conf = conf.astype(np.int64 if conf.dtype.kind in 'iub'
+                                else np.float64)
+        self._text, self._text_offsets = _pack_strings(text)
+        self._corrections = None
+        self._corrections_offsets = None
+        self._corrections_missing = None
+        if corrections is not None:
+            self._corrections, self._corrections_offsets = \
+                _pack_strings(corrections)
+            missing = pd.isnull(np.asarray(corrections, dtype=object))
+            if missing.any():
+                self._corrections_missing = np.flatnonzero(missing)
+
+    def __len__(self):
+        return len(self.left)
+
+    @property
+    def text(self):
+        return _unpack_strings(self._text, self._text_offsets)
+
+    @property
+    def corrections(self):
+        if self._corrections is None:
+            return None
+        corrections = _unpack_strings(self._corrections,
+                                      self._corrections_offsets)
+        if self._corrections_missing is not None:
+            for index in self._corrections_missing.tolist():
+                corrections[index] = np.nan
+        return corrections
+
+    @classmethod
+    def from_dataframe(cls, df):
+        conf = pd.to_numeric(df['conf'], errors='coerce').fillna(-1) \
+            if 'conf' in df else np.full(len(df), -1.0)
+        corrections = df['corrections'].tolist() \
+            if 'corrections' in df else None
+        return cls(*(df[col].to_numpy() for col in cls.COORDINATES),
+                   conf, df['text'].tolist(), corrections)
+
+    @classmethod
+    def from_entries(cls, entries):
+        '''
+        entries - WordBoxes, dataframe or (legacy) dict form of a dataframe
+        '''
+        if entries is None or isinstance(entries, cls):
+            return entries
+        if isinstance(entries, pd.DataFrame):
+            return cls.from_dataframe(entries)
+        return cls.from_dataframe(pd.DataFrame.from_dict(entries))
+
+    def to_dataframe(self):
+        df = pd.DataFrame({'level': np.full(len(self), 5, dtype=np.int32),
+                           'left': self.left,
+                           'top': self.top,
+                           'width': self.width,
+                           'height': self.height,
+                           'conf': self.conf,
+                           'text': self.text})
+        if self._corrections is not None:
+            df['corrections'] = self.corrections
+        return df
+
+    def to_dict(self):
+        '''
+        json compatible dict of columns (readable by from_entries)
+        '''
+        d = {col: getattr(self, col).tolist()
+             for col in self.COORDINATES + ['conf']}
+        d['text'] = self.text
+        if self._corrections is not None:
+            d['corrections'] = self.corrections
+        return d
+
+
+def entries_dataframe(entries):
+    '''
+    dataframe of page entries in any form, empty dataframe for None
+    '''
+    boxes = WordBoxes.from_entries(entries)
+    if boxes is None:
+        return WordBoxes([], [], [], [], [], []).to_dataframe()
+    return boxes.to_dataframe()
+
+
+def page_entries_payload(entries, correction_included):
+    '''
+    service json of page entries built from the columns in bulk
+    return (list of entry dicts, page text, entities)
+    '''
+    boxes = WordBoxes.from_entries(entries)
+    if boxes is None or len(boxes) == 0:
+        return [], "", []
+
+    texts = boxes.text
+    corrections = boxes.corrections
+    if not correction_included or corrections is None:
+        corrections = [""] * len(texts)
+    else:
+        corrections = ["" if c == '[UNK]' else c for c in corrections]
+    times = [None] * len(texts)  # entry.time
+
+    converted_entries = [
+        {
+            "top": top,
+            "conf": conf,
+            "left": left,
+            "text": text,
+            "width": width,
+            "height": height,
+            "time": time,
+            "correction": correction
+        }
+        for top, conf, left, text, width, height, time, correction in zip(
+            boxes.top.tolist(), boxes.conf.tolist(), boxes.left.tolist(),
+            texts, boxes.width.tolist(), boxes.height.tolist(), times,
+            corrections)
+    ]
+
+    # entity offsets in the space joined text
+    ends = np.cumsum([len(text) + 1 for text in texts]) - 1
+    entities = [
+        {
+            "start": int(end) - len(text),
+            "end": int(end),
+            "score": 1.0,
+            "type": "time",
+            "value": time,
+        }
+        for text, end, time in zip(texts, ends, times) if time
+    ]
+
+    return converted_entries, " ".join(texts), entities
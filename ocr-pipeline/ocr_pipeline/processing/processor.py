@@ -3,7 +3,10 @@ import tempfile
 
 from loguru import logger
 
+from ocr_pipeline.pipeline.helpers import create_worker_pool, \
+    close_worker_pool, init_worker
 from ocr_pipeline.pipeline.pipeline import Pipeline
+from ocr_pipeline.processing.result_cache import ResultCache
 from ocr_pipeline.service.config import Config
 from ocr_pipeline.service.filestorage import FileStorage
 
@@ -14,11 +17,22 @@ class Processor:
         self.fs = fs
         self.pipeline = Pipeline(config.pipeline)
         self.pipeline.setup()
+        self.cache = ResultCache.from_config(config, fs)
+        self.uploaded = []
         # TODO: do everything that should be initialized once (e.g. bert model)
+        pipeline_config = config.pipeline
+        create_worker_pool(pipeline_config.N_CPU, pipeline_config.batch_size,
+                           initializer=init_worker,
+                           initargs=self.pipeline.worker_initargs())
+
+    def close(self):
+        close_worker_pool()
 
     def run(self, body: dict) -> dict:
         logger.info("Processing message {}", body)
         lang = body.get("lang", self.pipeline.config.tess_lang)
+        correction_profile = body.get("correction_profile",
+                                      self.pipeline.config.correction_profile)
         file = body["minio"]
 
         with tempfile.TemporaryDirectory(prefix="preprocessing") as tmp_dir:
@@ -27,9 +41,22 @@ class Processor:
             case_folder = tmp_file.parent
             case_folder.mkdir(parents=True, exist_ok=True)
             self.fs.get(file, tmp_file)
-            results = self.pipeline.process_single(tmp_file, lang)
 
-            return self.upload_files(tmp_dir_path, results)
+            key = None
+            if self.cache is not None:
+                key = self.cache.key(tmp_file, f"{lang}-{correction_profile}")
+                results = self.cache.get(key, file)
+                if results is not None:
+                    return results
+
+            results = self.pipeline.process_single(tmp_file, lang,
+                                                   correction_profile)
+
+            self.uploaded = []
+            results = self.upload_files(tmp_dir_path, results)
+            if key is not None:
+                self.cache.put(key, file, results, self.uploaded)
+            return results
 
     def upload_files(self, case_folder: Path, d: dict) -> dict:
         for key in d.keys():
@@ -52,4 +79,5 @@ class Processor:
 
         relative_path = f"{file.relative_to(case_folder)}"
         self.fs.put(file, relative_path)
-        return relative_path
\ No newline at end of file
+        self.uploaded.append(relative_path)
+        return relative_path
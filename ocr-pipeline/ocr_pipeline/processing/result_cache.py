@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from loguru import logger
+
+from ocr_pipeline.service.filestorage import FileStorage
+
+RESULT_FILE = "result.json"
+# seconds between two full scans of the cache prefix
+EVICT_INTERVAL = 3600
+
+
+def file_sha256(path: Path, chunk_size: int = 1 << 20) -> str:
+    """sha256 of the file content, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _timestamp(info: dict) -> float:
+    modified = info.get("LastModified")
+    if isinstance(modified, datetime):
+        if modified.tzinfo is None:
+            modified = modified.replace(tzinfo=timezone.utc)
+        return modified.timestamp()
+    return time.time()
+
+
+class ResultCache:
+    """Content-addressed cache of whole-document results in the object store
+
+    An entry lives under ``<prefix>/<key>/`` and consists of a copy of every
+    uploaded artifact plus ``result.json`` holding the result dict, the source
+    path it was produced for, the list of artifact paths and their size. On a
+    hit the artifacts are copied next to the new source and the paths in the
+    result dict are rewritten accordingly.
+
+    The prefix is only listed for eviction on the first put, every
+    evict_interval seconds and when the sizes added since the last scan
+    exceed max_size.
+    """
+
+    def __init__(self, fs: FileStorage, prefix: str, ttl: int,
+                 max_size: int, version: str,
+                 evict_interval: int = EVICT_INTERVAL):
+        self.fs = fs
+        self.prefix = prefix.strip("/")
+        self.ttl = ttl
+        self.max_size = max_size
+        self.version = version
+        self.evict_interval = evict_interval
+        # size of the cache as of the last scan plus the entries added since
+        self._size = None
+        self._last_evict = 0
+
+    @classmethod
+    def from_config(cls, config, fs: FileStorage):
+        if not config.cache.enabled:
+            return None
+        version = f"{config.cache.version}-{config.pipeline.version()}"
+        return cls(fs, config.cache.prefix, config.cache.ttl,
+                   config.cache.max_size, version)
+
+    def key(self, file: Path, lang: str) -> str:
+        digest = hashlib.sha256()
+        digest.update(file_sha256(file).encode())
+        digest.update(f"|{lang}|{self.version}".encode())
+        return digest.hexdigest()
+
+    def _entry(self, key: str) -> str:
+        return f"{self.prefix}/{key}"
+
+    def get(self, key: str, source: str):
+        """return the result dict relinked to source or None on a miss"""
+        result_file = f"{self._entry(key)}/{RESULT_FILE}"
+        try:
+            info = self.fs.info(result_file)
+        except FileNotFoundError:
+            return None
+
+        if time.time() - _timestamp(info) > self.ttl:
+            logger.info(f"Result cache entry {key} expired")
+            self._remove(key)
+            return None
+
+        start = time.time()
+        try:
+            entry = json.loads(self.fs.cat(result_file))
+            mapping = self._relink(key, entry, source)
+        except Exception as e:
+            logger.warning(f"Result cache entry {key} unusable: {e}")
+            self._remove(key)
+            return None
+        logger.info(f"Result cache hit {key} for {source} "
+                    f"in {time.time() - start:.3f}s")
+        return _replace_paths(entry["result"], mapping)
+
+    def put(self, key: str, source: str, result: dict, files: list):
+        """store result and copies of the uploaded files"""
+        entry_dir = self._entry(key)
+        try:
+            size = 0
+            for file in files:
+                target = f"{entry_dir}/{_relative(file, source)}"
+                self.fs.copy(file, target)
+                size += self.fs.info(target).get("Size", 0)
+            entry = {"source": source, "result": result, "files": files,
+                     "size": size}
+            # s3fs < 0.3 only opens files in binary mode
+            with self.fs.open(f"{entry_dir}/{RESULT_FILE}", "wb") as f:
+                f.write(json.dumps(entry).encode())
+        except Exception as e:
+            logger.warning(f"Could not store result cache entry {key}: {e}")
+            self._remove(key)
+            return
+
+        if self._size is not None:
+            self._size += size
+        if self._size is None or self._size > self.max_size or \
+                time.time() - self._last_evict > self.evict_interval:
+            try:
+                self.evict()
+            except Exception as e:
+                logger.warning(f"Result cache eviction failed: {e}")
+
+    def _relink(self, key: str, entry: dict, source: str) -> dict:
+        """copy the cached files next to source, return old to new paths"""
+        mapping = {}
+        for file in entry["files"]:
+            relative = _relative(file, entry["source"])
+            target = _rebase(relative, entry["source"], source)
+            self.fs.copy(f"{self._entry(key)}/{relative}", target)
+            mapping[file] = target
+        return mapping
+
+    def evict(self):
+        """drop expired entries, then the oldest until max_size is met"""
+        now = time.time()
+        entries = {}
+        # one recursive listing, info is answered from its listing cache
+        for path in self.fs.walk(self.prefix, refresh=True):
+            info = self.fs.info(path)
+            key = path[len(self.prefix):].lstrip("/").split("/", 1)[0]
+            # entries without result.json are still being written
+            size, modified = entries.get(key, (0, now))
+            if path.endswith(f"/{RESULT_FILE}"):
+                modified = _timestamp(info)
+            entries[key] = (size + info.get("Size", 0), modified)
+
+        total = 0
+        for key, (size, modified) in sorted(entries.items(),
+                                            key=lambda e: -e[1][1]):
+            if now - modified > self.ttl or total + size > self.max_size:
+                logger.info(f"Evict result cache entry {key}")
+                self._remove(key)
+            else:
+                total += size
+        self._size = total
+        self._last_evict = now
+
+    def _remove(self, key: str):
+        try:
+            self.fs.rm(self._entry(key), recursive=True)
+        except FileNotFoundError:
+            pass
+
+
+def _relative(file: str, source: str) -> str:
+    return os.path.relpath(file, os.path.dirname(source))
+
+
+def _rebase(relative: str, old_source: str, new_source: str) -> str:
+    """artifacts are named after the source file, rename them accordingly"""
+    old_stem = Path(old_source).stem
+    new_stem = Path(new_source).stem
+    if relative.startswith(old_stem):
+        relative = new_stem + relative[len(old_stem):]
+    return f"{os.path.dirname(new_source)}/{relative}"
+
+
+def _replace_paths(d, mapping: dict):
+    if isinstance(d, dict):
+        return {k: _replace_paths(v, mapping) for k, v in d.items()}
+    if isinstance(d, list):
+        return [_replace_paths(v, mapping) for v in d]
+    if isinstance(d, str):
+        return mapping.get(d, d)
+    return d
@@ -91,6 +91,59 @@ class MinioConfig(RequiredConfigMixin):
         return self.config(*args, **kwargs)
 
 
+class CacheConfig(RequiredConfigMixin):
+    """Contains the result cache information"""
+    required_config = ConfigOptions()
+
+    required_config.add_option(
+        'enabled',
+        parser=bool,
+        default="False",
+        doc='Reuse results of identical files (same content, language and '
+            'pipeline config)'
+    )
+
+    required_config.add_option(
+        'prefix',
+        parser=str,
+        default="ocr-cache/results",
+        doc='Object store location (bucket/prefix) of the cache entries'
+    )
+
+    required_config.add_option(
+        'ttl',
+        parser=int,
+        default="2592000",
+        doc='Seconds a cache entry is valid'
+    )
+
+    required_config.add_option(
+        'max_size',
+        parser=int,
+        default="10737418240",
+        doc='Maximum size of all cache entries in bytes, the oldest entries '
+            'are evicted first'
+    )
+
+    required_config.add_option(
+        'version',
+        parser=str,
+        default="1",
+        doc='Bump to invalidate all entries, e.g. after pipeline code changes'
+    )
+
+    def __init__(self, config):
+        self.config = config.with_options(self)
+        self.enabled = self.config('enabled')
+        self.prefix = self.config('prefix')
+        self.ttl = self.config('ttl')
+        self.max_size = self.config('max_size')
+        self.version = self.config('version')
+
+    def __call__(self, *args, **kwargs):
+        return self.config(*args, **kwargs)
+
+
 class Config(object):
     def __init__(self):
         self.manager = ConfigManager(
@@ -108,4 +161,5 @@ class Config(object):
         self.amqp = AmqpConfig(self.manager.with_namespace('amqp'))
         self.minio = MinioConfig(self.manager.with_namespace('minio'))
         self.pipeline = PipelineConfig(self.manager.with_namespace('pipeline'))
+        self.cache = CacheConfig(self.manager.with_namespace('cache'))
 
@@ -125,6 +125,7 @@ class OcrService(ConsumerProducerMixin, threading.Thread):
 
     def stop(self):
         self.executor.shutdown()
+        self.processor.close()
         self.should_stop = True
 
     def get_consumers(self, Consumer, channel):
@@ -0,0 +1,120 @@
+import io
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("loguru")
+pytest.importorskip("s3fs")
+
+from ocr_pipeline.processing.result_cache import ResultCache  # noqa: E402
+
+
+class FakeFile(io.BytesIO):
+    def __init__(self, fs, path):
+        super().__init__()
+        self.fs = fs
+        self.path = path
+
+    def close(self):
+        self.fs.files[self.path] = (self.getvalue(),
+                                    datetime.now(timezone.utc))
+        super().close()
+
+
+class FakeFileSystem:
+    """in-memory subset of the s3fs 0.2 api used by ResultCache"""
+
+    def __init__(self):
+        self.files = {}
+        self.walks = 0
+
+    def info(self, path):
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        data, modified = self.files[path]
+        return {"Key": path, "Size": len(data), "LastModified": modified}
+
+    def cat(self, path):
+        return self.files[path][0]
+
+    def copy(self, path1, path2):
+        self.files[path2] = (self.cat(path1), datetime.now(timezone.utc))
+
+    def open(self, path, mode="rb"):
+        assert "b" in mode, "s3fs 0.2 has no text mode"
+        return FakeFile(self, path)
+
+    def rm(self, path, recursive=False):
+        for key in [k for k in self.files
+                    if k == path or k.startswith(f"{path}/")]:
+            del self.files[key]
+
+    def walk(self, path, refresh=False):
+        self.walks += 1
+        return [k for k in self.files if k.startswith(f"{path}/")]
+
+
+def upload_document(fs, source):
+    stem = source.rsplit("/", 1)[1].rsplit(".", 1)[0]
+    case = source.rsplit("/", 1)[0]
+    pdf = f"{case}/{stem}_result.pdf"
+    page = f"{case}/{stem}_page_0.png"
+    fs.files[pdf] = (b"pdf", datetime.now(timezone.utc))
+    fs.files[page] = (b"page", datetime.now(timezone.utc))
+    return {"pdf": pdf, "pages": [{"preprocessing": {"minio": page}}]}, \
+        [pdf, page]
+
+
+@pytest.fixture
+def document(tmp_path):
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"%PDF-1.4 document")
+    return path
+
+
+def test_put_get(document):
+    fs = FakeFileSystem()
+    cache = ResultCache(fs, "cache/results", ttl=3600, max_size=1 << 20,
+                        version="1")
+    key = cache.key(document, "deu")
+    assert cache.get(key, "upload/case/doc.pdf") is None
+
+    result, files = upload_document(fs, "upload/case/doc.pdf")
+    cache.put(key, "upload/case/doc.pdf", result, files)
+    assert fs.info(f"cache/results/{key}/result.json")
+
+    hit = cache.get(key, "upload/other/copy.pdf")
+    assert hit == {"pdf": "upload/other/copy_result.pdf",
+                   "pages": [{"preprocessing": {
+                       "minio": "upload/other/copy_page_0.png"}}]}
+    assert fs.cat("upload/other/copy_result.pdf") == b"pdf"
+    assert fs.cat("upload/other/copy_page_0.png") == b"page"
+
+    entry = json.loads(fs.cat(f"cache/results/{key}/result.json"))
+    assert entry["size"] == len(b"pdf") + len(b"page")
+
+
+def test_put_does_not_list_prefix_every_time(tmp_path):
+    fs = FakeFileSystem()
+    cache = ResultCache(fs, "cache/results", ttl=3600, max_size=1 << 20,
+                        version="1")
+    for i in range(5):
+        source = f"upload/case{i}/doc.pdf"
+        result, files = upload_document(fs, source)
+        cache.put(f"key{i}", source, result, files)
+        assert cache.get(f"key{i}", source) is not None
+    assert fs.walks == 1
+
+
+def test_evict_oldest_over_max_size():
+    fs = FakeFileSystem()
+    cache = ResultCache(fs, "cache/results", ttl=3600,
+                        max_size=len(b"pdf") + len(b"page"), version="1")
+    result, files = upload_document(fs, "upload/a/doc.pdf")
+    cache.put("old", "upload/a/doc.pdf", result, files)
+    result, files = upload_document(fs, "upload/b/doc.pdf")
+    cache.put("new", "upload/b/doc.pdf", result, files)
+
+    assert cache.get("new", "upload/b/doc.pdf") is not None
+    assert cache.get("old", "upload/a/doc.pdf") is None